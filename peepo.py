@@ -2,39 +2,188 @@
 """peepo.
 
 Usage:
-  peepo <command_file> [--spool=<spool_dir>] [--once] [--force] [--cols=<cols>] [--script]
+  peepo <command_file> [--spool=<spool_dir>] [--spool-size=<size>] [--compress] [--once] [--force] [--cols=<cols>]
+        [--rows=<rows>] [--script] [--stream] [--viewport] [--warm] [--branch=<branch>] [--preview]
+        [--preview-lines=<lines>] [--stats] [--trace=<file>] [--trace-format=<format>] [--debounce=<ms>]
+        [--limit=<limit>...] [--cutoff] [--attach]
+  peepo --daemon [--spool=<spool_dir>] [--spool-size=<size>] [--compress] [--stream] [--warm] [--preview]
+        [--preview-lines=<lines>] [--stats] [--trace=<file>] [--trace-format=<format>] [--jobs=<jobs>]
+        [--debounce=<ms>] [--limit=<limit>...] [--cutoff]
+  peepo <command_file> --batch=<inputs>... [--batch-out=<dir>] [--jobs=<jobs>] [--spool=<spool_dir>]
+        [--spool-size=<size>] [--compress] [--force] [--warm] [--branch=<branch>] [--trace=<file>]
+        [--trace-format=<format>] [--limit=<limit>...] [--cutoff]
   peepo (-h | --help)
 
 Options:
   -h --help                Show this screen.
   -s --spool=<spool_dir>   Spool directory for caching (default: <script dir>/spool)
+  --spool-size=<size>      Maximum total size of the spool directory, e.g. 500M or 2G.
+                           Least recently used outputs are removed first. [default: 1G]
+  --compress               Gzip command outputs in the spool directory.
   -o --once                Run only once instead of watching for file changes.
-  -f --force               Don't use cached outputs but rerun all commands instead.
+  -f --force               Don't use cached outputs but rerun all commands instead, except pinned ones.
                            Only when peepo runs first time. On file changes or up/down caching will be used.
   -c --cols=<cols>         Overwrite number of columns in terminal (default: read via 'stty size')
+  --rows=<rows>            Overwrite number of rows in terminal (default: read via 'stty size')
   --script                 Convert command file to a standalone shell script and write it to stdout.
+  --stream                 Start all commands that need to run together as one pipeline instead of one after another.
+                           Each command's output is still written to the spool as it flows to the next command.
+  --viewport               Only show one screen of the last command's output at a time and page through it with keys.
+  --warm                   Run python blocks in forks of a resident python process that already imported helpers.py,
+                           and other commands in forks of a resident bash that already loaded peepo.bashrc,
+                           instead of starting a new interpreter or shell for each command.
+  --branch=<branch>        Branch to show first, see #@branch (default: main, or the first branch if main is empty).
+  --preview                Feed commands that need to run only the first lines of the cached input and show the result
+                           right away, then run them on the full input in the background and show that result instead.
+  --preview-lines=<lines>  Number of lines to feed commands in preview mode. [default: 1000]
+  --stats                  Show the stats of each command below the status line: whether its output was cached,
+                           wall time, CPU time, peak memory and the size of its input and output.
+  --trace=<file>           Write the stats of every command that runs or uses its cached output to a file.
+  --trace-format=<format>  Format of the trace file: jsonl for one JSON object per command, or chrome for the
+                           Chrome trace event format, which chrome://tracing and Perfetto can open. [default: jsonl]
+  --debounce=<ms>          Milliseconds to wait for further changes to the command file before running it, since editors
+                           often save a file in several steps. [default: 100]
+  --limit=<limit>          Limit every command, with time=<duration> to its wall time, output=<size> to the size of its
+                           output, cpu=<duration> to the CPU time and memory=<size> to the address space of each of
+                           its processes, e.g. --limit=time=5m. Can be given several times. See #@limit.
+  --cutoff                 Hash the output of every command, so the commands after a command whose output didn't change
+                           use their cached outputs. Costs throughput, since outputs pass through peepo to be hashed.
+  --daemon                 Watch and run the command files of all attached clients in one resident process, see --attach.
+  --jobs=<jobs>            Maximum number of command files the daemon runs commands for at the same time,
+                           or of batch inputs that run at the same time. [default: 4]
+  --attach                 Let the daemon on the same spool directory watch and run the command file, and only show
+                           its output and pass on keys. The options that change how commands run are the daemon's.
+  --batch=<inputs>         Run the commands once for every file matching the glob, with the file as input of the first
+                           command, and write the outputs to stdout in order. Can be given several times.
+  --batch-out=<dir>        Write the output for each batch input to a file of the same name in dir instead of stdout.
 
 """
 import os
 from pathlib import Path
 import subprocess
 import pty
+import termios
+import fcntl
+import signal
+import asyncio
 import hashlib
 import re
 import sys
 import shutil
+import threading
+import gzip
+import sqlite3
+import time
+import socket
+import select
+import stat
+import array
+import json
+import tempfile
+import shlex
+import concurrent.futures
+import glob
+import itertools
+import runpy
+import resource
+import traceback
 from docopt import docopt
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
 COLUMNS = 60
+ROWS = 24
 SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
 SPOOL_DIR = os.path.join(SCRIPT_DIR, 'spool')
 BASHRC_FILE_NAME = f"{SCRIPT_DIR}/peepo.bashrc"
 LOAD_BASHRC_CMD = f'[ -f "{BASHRC_FILE_NAME}" ] && . {BASHRC_FILE_NAME}'
-MAX_SPOOL_FILES = 200
+MAX_SPOOL_BYTES = 1024**3
+GZIP_SUFFIX = ".gz"
+# Favor speed over ratio, command outputs are compressed while they are produced:
+GZIP_COMPRESS_LEVEL = 1
+COMPRESS = False
+# Limits of every command, see --limit and #@limit. None means unlimited:
+LIMITS = {"time": None, "output": None, "cpu": None, "memory": None}
+# How long the command file has to be left alone after a change before it runs, see watch_file:
+DEBOUNCE_SECONDS = 0.1
+MANIFEST_FILE_NAME = "manifest.db"
+MANIFEST_DB = None
+MANIFEST_LOCK = threading.Lock()
+SPOOL_LOCK_SUFFIX = ".lock"
+SPOOL_LOCK_POLL_SECONDS = 0.05
+SCRIPT_MAX_IDLE_SECONDS = 7 * 24 * 60 * 60
+TEMP_SUFFIX = ".tmp"
+# Temporary files this old are left behind even if a process with their writer's pid runs, see is_stale_temp_file:
+TEMP_MAX_AGE_SECONDS = 24 * 60 * 60
+SIZE_UNITS = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+DURATION_UNITS = {"": 1, "s": 1, "m": 60, "h": 60 * 60, "d": 24 * 60 * 60}
+WARM_BLOCKS = False
+PYTHON_SERVER = {"proc": None, "lock": threading.Lock()}
+BASH_SERVER = {"proc": None, "lock": threading.Lock()}
+# Main loop of the bash server. It sources peepo.bashrc once and then reads requests from stdin:
+# the paths of a response pipe and of stdin, stdout and stderr, the command length and the working directory,
+# followed by the command itself. Each command runs in a fork, which sends its pid and exit code to the response pipe,
+# or a pid of 0 if it couldn't open the files.
+BASH_SERVER_LOOP = r"""
+while read -r response stdin stdout stderr length cwd; do
+    LC_ALL=C read -r -N "$length" cmd
+    (
+        exec 3>"$response"
+        # Appending, so output files aren't truncated:
+        if ! exec 4<"$stdin" 5>>"$stdout" 6>>"$stderr"; then
+            echo 0 >&3
+            exit
+        fi
+        # Job control gives the command its own process group, so it can be killed like any other command:
+        set -m
+        ( cd "$cwd" && exec 0<&4 1>&5 2>&6 3>&- 4<&- 5>&- 6>&- && eval "$cmd" ) &
+        exec 4<&- 5>&- 6>&-
+        echo "$!" >&3
+        wait "$!"
+        echo "$?" >&3
+    ) 2>/dev/null &
+done
+"""
+# Set to a dict with the displayed file and top offset when in viewport mode:
+VIEWPORT = None
+VIEWPORT_MAX_LINE_BYTES = 4096
+VIEWPORT_CHUNK_SIZE = 64 * 1024
+PIPE_BUFFER_SIZE = 64 * 1024
+SPOOL_COPY_SIZE = 1024 * 1024
+STREAM = False
+# Whether outputs are hashed to reuse the outputs of the commands after an unchanged output, see --cutoff:
+CUTOFF = False
+PREFETCH = False
+STATS = False
+# Set to a dict with the open trace file and its format when tracing:
+TRACE = None
+# Preview mode, where commands first run on a sample of their input:
+SAMPLE = {"enabled": False, "lines": 1000}
+# Lines starting with #@ set options for the next command, e.g. "#@deps data.csv":
+DIRECTIVE_PREFIX = "#@"
+# Names of the directives, other lines starting with #@ are comments:
+DIRECTIVES = ["deps", "ttl", "always", "pin", "branch", "limit"]
+# Name of the branch with the commands before the first #@branch directive:
+MAIN_BRANCH = "main"
+# Words and quoted strings in commands that could be the path of a file the command reads:
+FILE_REFERENCE_PATTERN = re.compile(r"""["']([^"'\n]+)["']|([^\s"'<>|;&()]+)""")
+# Files commands write to, which aren't files they read: redirection targets, values of -o and --output and
+# the arguments of tee:
+OUTPUT_FILE_PATTERN = re.compile(r""">\|?\s*["']?([^\s"'<>|;&()]+)|(?:^|[\s;&|(])(?:-o|--output)(?:=|\s+)["']?([^\s"'<>|;&()]+)"""
+                                 r"""|(?:^|[\s;&|(])tee((?:\s+[^\s<>|;&()]+)+)""")
+# Helper file contents by file name, with the size and modification time they were read at:
+HELPER_CONTENTS = {}
+# By command file, what was prepared for each of its commands when it was last parsed, by type, content and
+# helper content:
+PREPARED_COMMANDS = {}
+DAEMON_SOCKET_FILE_NAME = "daemon.sock"
+# Settings of the client a thread works for in daemon mode, e.g. its output file descriptor, see run_session:
+SESSION = threading.local()
 # From https://stackoverflow.com/a/14693789:
-ANSI_ESCAPE_PATTERN = re.compile(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
+ANSI_ESCAPE_PATTERN = re.compile(rb'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
+# Matches what can still become an escape sequence when more data follows:
+ANSI_ESCAPE_PREFIX_PATTERN = re.compile(rb'\x1B(?:\[[0-?]*[ -/]*)?')
+MAX_ANSI_ESCAPE_PREFIX_LENGTH = 64
 
 
 def main(args):
@@ -42,10 +191,31 @@ def main(args):
         global SPOOL_DIR  # pylint: disable=global-statement
         SPOOL_DIR = args["--spool"]
 
+    if args["--attach"]:
+        sys.exit(attach_to_daemon(args))
+
+    global STREAM, CUTOFF, COMPRESS, MAX_SPOOL_BYTES, WARM_BLOCKS, STATS, DEBOUNCE_SECONDS  # pylint: disable=global-statement
+    STREAM = args["--stream"]
+    CUTOFF = args["--cutoff"]
+    STATS = args["--stats"]
+    SAMPLE.update(enabled=args["--preview"], lines=int(args["--preview-lines"]))
+    WARM_BLOCKS = args["--warm"]
+    COMPRESS = args["--compress"]
+    MAX_SPOOL_BYTES = parse_size(args["--spool-size"])
+    DEBOUNCE_SECONDS = int(args["--debounce"]) / 1000
+    LIMITS.update(parse_limits(args["--limit"]))
+
     os.makedirs(SPOOL_DIR, exist_ok=True)
+    open_manifest()
+    if args["--trace"] is not None:
+        open_trace(args["--trace"], args["--trace-format"])
 
     if args["--script"]:
         convert_peepo_script(args)
+    elif args["--daemon"]:
+        run_daemon(int(args["--jobs"]))
+    elif args["--batch"]:
+        sys.exit(run_batch(args))
     else:
         run_peepo_script(args)
 
@@ -55,62 +225,377 @@ def run_peepo_script(args):
     prepare_helper_files()
     tidy_spool()
 
-    global COLUMNS  # pylint: disable=global-statement
-    if args["--cols"] is None:
-        _, cols = os.popen('stty size', 'r').read().split()
-        COLUMNS = int(cols)
-    else:
-        COLUMNS = int(args["--cols"])
+    global COLUMNS, ROWS, VIEWPORT, PREFETCH  # pylint: disable=global-statement
+    COLUMNS, ROWS = read_terminal_size(args)
+    # Nobody navigates when running only once:
+    PREFETCH = not args["--once"]
 
-    command_file = os.path.abspath(args["<command_file>"])
+    if args["--viewport"]:
+        VIEWPORT = {"file": None, "reader": None, "top": 0, "status": "", "lock": threading.RLock()}
 
-    state = {"up_to_offset": 0, "commands": parse_command_file(command_file)}
+    try:
+        run_session(args, {}, RunExecutor(), listen_for_terminal_keys)
+    finally:
+        stop_python_server()
+        stop_bash_server()
 
-    run_commands_and_show_result(state["commands"], force=args["--force"])
 
-    def on_command_file_changed():
-        state["commands"] = parse_command_file(command_file)
-        state["up_to_offset"] = 0
-        run_commands_and_show_result(state["commands"])
+def run_session(args, session, executor, listen, observer=None):
+    """Runs the command file and reruns it when it changes or on keys, until listen returns.
 
-    if not args["--once"]:
-        stop = watch_file(command_file, on_command_file_changed)
-        listen_for_keys(state)
+    session holds the settings of a daemon client, see serve_client, and is empty otherwise.
+    The command file is watched with observer if given, or with a new one."""
+    command_file = os.path.abspath(args["<command_file>"])
+    branches = parse_command_file(command_file, session.get("cwd"))
+    branch = args["--branch"] if args["--branch"] in branches else default_branch(branches)
+    state = {"up_to_offset": 0, "branches": branches, "branch": branch, "executor": executor}
+
+    try:
+        first_run = state["executor"].submit(run_commands_and_show_result, state["branches"], state["branch"], 0,
+                                             0 if args["--force"] else None)
+        if args["--once"]:
+            first_run.result()
+            return
+
+        def on_command_file_changed():
+            state["branches"] = parse_command_file(command_file, session.get("cwd"))
+            if state["branch"] not in state["branches"]:
+                state["branch"] = default_branch(state["branches"])
+            state["up_to_offset"] = 0
+            state["executor"].submit(run_commands_and_show_result, state["branches"], state["branch"])
+
+        stop = watch_file(command_file, on_command_file_changed, observer)
+        listen(state)
         stop()
+    finally:
+        state["executor"].stop()
 
 
-def listen_for_keys(state):
-    os.system("stty raw -echo")
+def run_batch(args):
+    """Runs the commands of the command file for each batch input, see --batch, and returns the exit code.
+
+    Each input gets its own pipeline, with a first command that passes the input on. Its cache key covers the
+    input's path, size and modification time, so running the batch again only runs the commands for changed inputs."""
+    inputs = find_batch_inputs(args["--batch"])
+    if not inputs:
+        print("No batch inputs found", file=sys.stderr)
+        return 1
+
+    prepare_helper_files()
+    tidy_spool()
+    branches = parse_command_file(os.path.abspath(args["<command_file>"]))
+    branch = args["--branch"] if args["--branch"] in branches else default_branch(branches)
+    errors = [command["error"] for command in branches[branch]["commands"] if command["error"] is not None]
+    if errors:
+        print(f"Invalid directive: {errors[0]}", file=sys.stderr)
+        return 1
+    pipelines = [make_batch_pipeline(input_file, branches[branch]["commands"]) for input_file in inputs]
+    try:
+        return run_batch_pipelines(inputs, pipelines, args)
+    finally:
+        stop_python_server()
+        stop_bash_server()
+
+
+def run_batch_pipelines(inputs, pipelines, args):
+    """Runs the pipelines of the batch inputs in parallel, writes their outputs and returns the exit code."""
+    force_from = 0 if args["--force"] else None
+    runs = [new_run() for _ in inputs]
+    failed = 0
+    try:
+        with concurrent.futures.ThreadPoolExecutor(int(args["--jobs"])) as pool:
+            futures = [
+                # Without a pty, so only the commands' stdout ends up in the outputs:
+                pool.submit(run_commands, run, commands, len(commands), force_from, False, plain=True)
+                for run, commands in zip(runs, pipelines)
+            ]
+            # Outputs are written in the order of the inputs, as soon as all inputs before are done:
+            for input_file, commands, future in zip(inputs, pipelines, futures):
+                succeeded, cmds_ran, k = future.result()
+                if succeeded:
+                    write_batch_output(commands[-1], input_file, inputs, args["--batch-out"])
+                    # The command passing the input on only runs together with all others:
+                    print(f"OK (ran {min(cmds_ran, len(commands) - 1)}/{len(commands) - 1}) {input_file}", file=sys.stderr)
+                else:
+                    failed += 1
+                    print(f"Command {k} failed: {input_file}", file=sys.stderr)
+    except KeyboardInterrupt:
+        for run in runs:
+            cancel_run(run)
+        raise
+
+    return 1 if failed else 0
+
+
+def find_batch_inputs(patterns):
+    """Returns the absolute paths of the files that match the glob patterns, without duplicates."""
+    inputs = []
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern, recursive=True)):
+            path = os.path.abspath(path)
+            if os.path.isfile(path) and path not in inputs:
+                inputs.append(path)
+    return inputs
+
+
+def make_batch_pipeline(input_file, commands):
+    """Returns the commands for one batch input, after a command that passes the input on to them."""
+    content = f"cat {shlex.quote(input_file)}"
+    input_command = {"type": "command", "content": content, "directives": {}, "deps": [input_file]}
+    input_command.update(prepare_command(input_command["type"], content, {}))
+    # The commands are shared by all inputs, but their keys differ:
+    pipeline = [input_command] + [dict(command) for command in commands]
+    hash_commands(pipeline)
+    return pipeline
+
+
+def write_batch_output(command, input_file, inputs, out_dir):
+    """Writes the cached output of the last command for a batch input to stdout, or to out_dir if given.
+
+    In out_dir, the output file has the path of the input relative to the directory all inputs are in."""
+    with SpoolLock(command["hash"], exclusive=False, blocking=False):
+        with open_spool_reader(find_spool_file(get_output_file(command))) as output:
+            if out_dir is None:
+                sys.stdout.flush()
+                shutil.copyfileobj(output, sys.stdout.buffer)
+                sys.stdout.buffer.flush()
+                return
+
+            base_dir = os.path.commonpath([os.path.dirname(path) for path in inputs])
+            out_file_path = os.path.join(out_dir, os.path.relpath(input_file, base_dir))
+            os.makedirs(os.path.dirname(out_file_path), exist_ok=True)
+            with open(out_file_path, 'wb') as out_file:
+                shutil.copyfileobj(output, out_file)
+
+
+def run_daemon(jobs):
+    """Runs the command files of attached clients in one process, see attach_to_daemon.
+
+    The clients share one file watcher, the manifest, the warm servers and a pool of threads that runs at most
+    jobs command files at a time, so the number of clients doesn't change how many commands run in parallel."""
+    prepare_helper_files()
+    tidy_spool()
+
+    listener = listen_on_daemon_socket()
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+    observer = Observer()
+    observer.start()
+    sys.stdout = SessionOutput(sys.stdout)
+    # Clean up when killed as well as on ctrl+c:
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
     try:
         while True:
-            ctrl_char = ord(sys.stdin.read(1))
-            if ctrl_char == 27:
-                rest = sys.stdin.read(2)
-
-                updated_offset = state["up_to_offset"]
-                max_cmd_index = len(state["commands"]) - 1
-                if rest == "[A":  # up
-                    updated_offset = min(max_cmd_index, updated_offset + 1)
-                elif rest == "[B":  # down
-                    updated_offset = max(0, updated_offset - 1)
-                elif rest == "[H":  # home
-                    updated_offset = max_cmd_index
-                elif rest == "[F":  # end
-                    updated_offset = 0
-
-                if updated_offset != state["up_to_offset"]:
-                    state["up_to_offset"] = updated_offset
-                    run_commands_and_show_result(state["commands"], state["up_to_offset"])
-
-            elif ctrl_char == 114:  # r
-                run_commands_and_show_result(state["commands"], state["up_to_offset"], force=True)
-
-            elif ctrl_char in [3, 4, 113]:  # ctrl+c, ctrl+d, q
-                break
+            conn, _ = listener.accept()
+            threading.Thread(target=serve_client, args=(conn, pool, observer), daemon=True).start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+        os.remove(get_daemon_socket_path())
+        observer.stop()
+        stop_python_server()
+        stop_bash_server()
+
+
+def listen_on_daemon_socket():
+    socket_path = get_daemon_socket_path()
+    if os.path.exists(socket_path):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            if probe.connect_ex(socket_path) == 0:
+                raise SystemExit(f"A peepo daemon is already listening on {socket_path}")
+        # Left behind by a daemon that got killed:
+        os.remove(socket_path)
+
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(socket_path)
+    listener.listen()
+    return listener
+
+
+def serve_client(conn, pool, observer):
+    """Runs the command file of a client until it quits.
+
+    The client sends its arguments as one line of JSON, then keys, and gets the output the command file's
+    runs would show in a terminal."""
+    keys = conn.makefile('r', encoding="utf8")
+    try:
+        line = keys.readline()
+        if not line:
+            return
+        args = json.loads(line)
+        session = {"cwd": args["cwd"], "columns": int(args["--cols"]), "output_fd": conn.fileno(), "prefetch": not args["--once"]}
+        run_session(args, session, RunExecutor(pool, session), lambda state: listen_for_keys(state, keys.read), observer)
+    except OSError:
+        # The client went away.
+        pass
+    finally:
+        keys.close()
+        conn.close()
+
+
+def attach_to_daemon(args):
+    """Lets the daemon run the command file, see serve_client, and shows the output until the daemon is done.
+
+    Returns the exit code."""
+    socket_path = get_daemon_socket_path()
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(socket_path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        print(f"No peepo daemon is listening on {socket_path}, start one with --daemon", file=sys.stderr)
+        return 1
+
+    client_args = {name: args[name] for name in ["<command_file>", "--branch", "--force", "--once"]}
+    client_args.update({"--cols": read_terminal_size(args)[0], "cwd": os.getcwd()})
+    client_args["<command_file>"] = os.path.abspath(args["<command_file>"])
+    conn.sendall(json.dumps(client_args).encode("utf8") + b"\n")
+
+    if args["--once"]:
+        copy_daemon_output(conn)
+        return 0
+
+    os.system("stty raw -echo")
+    try:
+        threading.Thread(target=forward_keys, args=(conn, ), daemon=True).start()
+        copy_daemon_output(conn)
+    finally:
+        os.system("stty -raw echo")
+    return 0
+
+
+def forward_keys(conn):
+    while True:
+        keys = os.read(sys.stdin.fileno(), 1024)
+        if not keys:
+            break
+        try:
+            conn.sendall(keys)
+        except OSError:
+            break
+
+
+def copy_daemon_output(conn):
+    while True:
+        data = conn.recv(PIPE_BUFFER_SIZE)
+        if not data:
+            break
+        write_fully(sys.stdout.fileno(), data)
+    conn.close()
+
+
+def get_daemon_socket_path():
+    return os.path.join(SPOOL_DIR, DAEMON_SOCKET_FILE_NAME)
+
+
+def session_setting(name, default):
+    """Returns the setting of the daemon client the current thread works for, or default if there's none."""
+    return getattr(SESSION, name, default)
+
+
+class SessionOutput:
+    """Replaces sys.stdout in the daemon, so output goes to the client the current thread works for."""
+    def __init__(self, default):
+        self.default = default
+
+    def fileno(self):
+        return session_setting("output_fd", None) or self.default.fileno()
+
+    def write(self, text):
+        write_fully(self.fileno(), text.encode("utf8"))
+        return len(text)
+
+    def flush(self):
+        self.default.flush()
+
+
+def read_terminal_size(args):
+    cols = args["--cols"]
+    # Rows are only needed to fill the screen in viewport mode:
+    rows = args["--rows"] if args["--rows"] is not None or args["--viewport"] else ROWS
+    if cols is None or rows is None:
+        stty_rows, stty_cols = os.popen('stty size', 'r').read().split()
+        cols = cols if cols is not None else stty_cols
+        rows = rows if rows is not None else stty_rows
+    return int(cols), int(rows)
+
+
+def listen_for_terminal_keys(state):
+    os.system("stty raw -echo")
+    try:
+        listen_for_keys(state, sys.stdin.read)
     finally:
         os.system("stty -raw echo")
 
 
+def listen_for_keys(state, read):
+    while True:
+        key = read(1)
+        if not key:
+            break
+        ctrl_char = ord(key)
+        if ctrl_char == 27:
+            rest = read(2)
+            if rest[1].isdigit():
+                rest += read(1)
+            handle_escape_sequence(state, rest)
+
+        elif ctrl_char in [103, 71]:  # g, G
+            scroll_viewport_to_end(at_bottom=ctrl_char == 71)
+
+        elif ctrl_char == 114:  # r
+            submit_run(state, 0)
+
+        elif ctrl_char == 102:  # f
+            submit_run(state, len(get_branch_commands(state)) - 1 - state["up_to_offset"])
+
+        elif ctrl_char == 98:  # b
+            switch_branch(state)
+
+        elif ctrl_char == 112:  # p
+            SAMPLE["enabled"] = not SAMPLE["enabled"]
+            submit_run(state)
+
+        elif ctrl_char in [3, 4, 113]:  # ctrl+c, ctrl+d, q
+            break
+
+
+def handle_escape_sequence(state, rest):
+    if rest in ["[5~", "[6~"]:  # page up, page down
+        scroll_viewport(-1 if rest == "[5~" else 1)
+        return
+
+    updated_offset = state["up_to_offset"]
+    max_cmd_index = len(get_branch_commands(state)) - 1
+    if rest == "[A":  # up
+        updated_offset = min(max_cmd_index, updated_offset + 1)
+    elif rest == "[B":  # down
+        updated_offset = max(0, updated_offset - 1)
+    elif rest == "[H":  # home
+        updated_offset = max_cmd_index
+    elif rest == "[F":  # end
+        updated_offset = 0
+
+    if updated_offset != state["up_to_offset"]:
+        state["up_to_offset"] = updated_offset
+        submit_run(state)
+
+
+def switch_branch(state):
+    names = [name for name, branch in state["branches"].items() if branch["commands"]]
+    if state["branch"] in names and len(names) > 1:
+        state["branch"] = names[(names.index(state["branch"]) + 1) % len(names)]
+        state["up_to_offset"] = 0
+        submit_run(state)
+
+
+def submit_run(state, force_from=None):
+    state["executor"].submit(run_commands_and_show_result, state["branches"], state["branch"], state["up_to_offset"], force_from)
+
+
+def get_branch_commands(state):
+    return state["branches"][state["branch"]]["commands"]
+
+
 def prepare_helper_files():
     copy_from_template_if_exists(BASHRC_FILE_NAME)
 
@@ -126,20 +611,129 @@ def copy_from_template_if_exists(target_file):
 
 
 def tidy_spool():
-    paths = sorted(Path(SPOOL_DIR).iterdir(), key=os.path.getmtime, reverse=True)
-    for path in paths[MAX_SPOOL_FILES:]:
-        os.remove(path)
+    """Removes the least recently used outputs until the spool fits into MAX_SPOOL_BYTES.
+
+    Block scripts are tiny and prepared commands keep pointing at them, see prepare_commands, so they don't count
+    and aren't removed to make room, only once no command ran them for SCRIPT_MAX_IDLE_SECONDS.
+    Temporary files that crashed or killed peepo instances left behind are removed too."""
+    with os.scandir(SPOOL_DIR) as entries:
+        for entry in entries:
+            if entry.name.endswith(TEMP_SUFFIX) and is_stale_temp_file(entry):
+                remove_spool_entry(entry.name)
+
+    is_script = " OR ".join(["name LIKE ?"] * len(BLOCK_DEFS))
+    script_patterns = [f"%.{marker}" for marker in BLOCK_DEFS]
+    idle_scripts = query_manifest(f"SELECT name FROM entries WHERE ({is_script}) AND last_used < ?",
+                                  script_patterns + [time.time() - SCRIPT_MAX_IDLE_SECONDS])
+    for name, in idle_scripts:
+        remove_spool_entry(name)
+
+    total_size = query_manifest(f"SELECT COALESCE(SUM(size), 0) FROM entries WHERE NOT ({is_script})", script_patterns)[0][0]
+    if total_size <= MAX_SPOOL_BYTES:
+        return
+
+    # Cached outputs are touched when used, so the oldest last_used is the least recently used:
+    for name, size in query_manifest(f"SELECT name, size FROM entries WHERE NOT ({is_script}) ORDER BY last_used",
+                                     script_patterns):
+        if total_size <= MAX_SPOOL_BYTES:
+            break
+        # Paged through while it is shown, see show_viewport_file:
+        if VIEWPORT is not None and name == os.path.basename(VIEWPORT["file"] or ""):
+            continue
+        # Outputs that are being written or read by another peepo instance are in use, see SpoolLock:
+        with SpoolLock(name.split(".")[0], blocking=False) as lock:
+            if not lock.held:
+                continue
+            remove_spool_entry(name)
+        total_size -= size
 
 
-def parse_command_file(command_file):
+def temp_file_prefix(name):
+    """Returns the prefix of a temporary spool file for the spool file with the given name.
+
+    It includes the pid of this process, so tidy_spool can tell when the file's writer is gone."""
+    return f"{name}.{os.getpid()}."
+
+
+def is_stale_temp_file(entry):
+    """Returns whether the temporary spool file was left behind by a peepo instance that is gone, see temp_file_prefix.
+
+    A file without a pid, or whose pid may have been reused since, is stale once it is older than
+    TEMP_MAX_AGE_SECONDS and nobody runs the command it belongs to."""
+    try:
+        age = time.time() - entry.stat().st_mtime
+    except FileNotFoundError:
+        # Committed in the meantime:
+        return False
+    if age <= TEMP_MAX_AGE_SECONDS:
+        pid = entry.name.split(".")[-3] if entry.name.count(".") >= 3 else ""
+        return pid.isdigit() and not is_process_running(int(pid))
+    with SpoolLock(entry.name.split(".")[0], blocking=False) as lock:
+        return lock.held
+
+
+def is_process_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Runs as another user:
+        return True
+    return True
+
+
+def parse_size(size):
+    match = re.fullmatch(r"\s*(\d+)\s*([KMGT]?)B?\s*", size.upper())
+    if match is None:
+        raise ValueError(f"Invalid size: {size}")
+    return int(match.group(1)) * SIZE_UNITS[match.group(2)]
+
+
+def parse_duration(duration):
+    match = re.fullmatch(r"\s*(\d+)\s*([smhd]?)\s*", duration.lower())
+    if match is None:
+        raise ValueError(f"Invalid duration: {duration}")
+    return int(match.group(1)) * DURATION_UNITS[match.group(2)]
+
+
+def parse_limits(limits):
+    """Parses limits like "time=30s" or "output=10M" into a dict like LIMITS. "none" lifts a limit."""
+    parsed = {}
+    for limit in limits:
+        name, _, value = limit.partition("=")
+        if name not in LIMITS:
+            raise ValueError(f"Invalid limit: {limit}")
+        if value.lower() == "none":
+            parsed[name] = None
+        else:
+            parsed[name] = parse_size(value) if name in ["output", "memory"] else parse_duration(value)
+    return parsed
+
+
+def parse_command_file(command_file, cwd=None):
+    """Parses the command file into branches, see build_branches.
+
+    Relative paths of files the commands read are relative to cwd, or the current directory if None."""
     commands = []
     block_content = ""
     block_indent = -1
     active_block = None
+    directives = {}
+    error = None
 
     with open(command_file, 'r') as file:
         for line in file:
             line = line.rstrip()
+            try:
+                directive = parse_directive(line)
+            except ValueError as exc:
+                # Shown in the status line once the command would run, see run_commands:
+                error = error or f"{line}: {exc}"
+                continue
+            if directive is not None:
+                directives.setdefault(directive[0], []).extend(directive[1])
+                continue
             if line.startswith("#") or line.strip() == "":
                 continue
 
@@ -153,7 +747,9 @@ def parse_command_file(command_file):
                 elif line == marker + ")" and active_block:
                     is_block_marker = True
                     active_block = None
-                    commands.append({"type": marker, "content": block_content})
+                    commands.append({"type": marker, "content": block_content, "directives": directives, "error": error})
+                    directives = {}
+                    error = None
 
             if not is_block_marker:
                 if active_block:
@@ -162,13 +758,37 @@ def parse_command_file(command_file):
                         block_indent = len(line) - len(trimmed)
                     block_content += line[block_indent:] + "\n"
                 else:
-                    commands.append({"type": "command", "content": line})
+                    commands.append({"type": "command", "content": line, "directives": directives, "error": error})
+                    directives = {}
+                    error = None
+
+    return build_branches(prepare_commands(commands, command_file, cwd))
+
 
-    return prepare_commands(commands)
+def parse_directive(line):
+    """Returns the name and arguments of the directive on the line, e.g. ("deps", ["data.csv"]) for "#@deps data.csv",
+    or None if the line isn't a directive.
 
+    Raises ValueError if the arguments are malformed, so the directive is left out instead of failing when it is used."""
+    name, _, value = line[len(DIRECTIVE_PREFIX):].partition(" ")
+    if not line.startswith(DIRECTIVE_PREFIX) or name not in DIRECTIVES:
+        return None
 
-def prepare_commands(commands):
+    args = shlex.split(value)
+    if not args and name in ["deps", "ttl", "branch", "limit"]:
+        raise ValueError("Missing value")
+    if name == "ttl":
+        parse_duration(args[0])
+    elif name == "limit":
+        parse_limits(args)
+    return name, args
 
+
+def prepare_commands(commands, command_file, cwd=None):
+    """Sets the cache key parts, dependencies and preview of each command, and writes the scripts of blocks.
+
+    Commands that are unchanged since the command file was last parsed reuse what was prepared for them then,
+    so editing one line of a long command file only prepares that line again."""
     helpers = {}
     for marker, block_def in BLOCK_DEFS.items():
         if "helper_file" in block_def:
@@ -176,61 +796,312 @@ def prepare_commands(commands):
             if helper_content:
                 helpers[marker] = helper_content
 
+    last_prepared = PREPARED_COMMANDS.get(command_file, {})
+    prepared_commands = {}
+    for command in commands:
+        key = (command["type"], command["content"], helpers.get(command["type"], ""))
+        prepared = last_prepared.get(key) or prepare_command(command["type"], command["content"], helpers)
+        prepared_commands[key] = prepared
+
+        command.update(prepared)
+        deps = [os.path.join(cwd or "", dep) for dep in command["directives"].get("deps", [])]
+        candidates = [os.path.join(cwd or "", candidate) for candidate in prepared["file_candidates"]]
+        command["deps"] = deps + [candidate for candidate in candidates if os.path.isfile(candidate)]
+
+    PREPARED_COMMANDS[command_file] = prepared_commands
+    return commands
+
+
+def prepare_command(marker, content, helpers):
+    prepared = {
+        "hash_parts": [content],
+        "file_candidates": find_file_candidates(content),
+        "preview": make_preview(content),
+    }
+
+    block_def = BLOCK_DEFS.get(marker)
+    if block_def is not None:
+        script_content = content
+        if "mutate_block" in block_def:
+            script_content = block_def["mutate_block"](script_content)
+            prepared["preview"] = make_preview(script_content)
+
+        if marker in helpers:
+            script_content = helpers[marker] + script_content
+            prepared["hash_parts"].append(helpers[marker])
+
+        prepared["script_content"] = script_content
+        prepared["script_file"] = write_block_script(marker, script_content)
+        prepared["content"] = block_def["build_command"](prepared["script_file"])
+
+    return prepared
+
+
+def write_block_script(marker, script_content):
+    """Writes the script of a block to the spool, named after its content, and returns its path.
+
+    A changed block gets a new file, so it never overwrites the script of a block that is still running."""
+    script_file = os.path.join(SPOOL_DIR, f"{sha1(script_content)}.{marker}")
+    if find_spool_file(script_file) is not None and file_exists(script_file):
+        touch_spool_file(script_file)
+        return script_file
+
+    with tempfile.NamedTemporaryFile('w',
+                                     dir=SPOOL_DIR,
+                                     prefix=temp_file_prefix(os.path.basename(script_file)),
+                                     suffix=TEMP_SUFFIX,
+                                     delete=False) as file:
+        file.write(script_content)
+    os.replace(file.name, script_file)
+    record_spool_file(script_file, 0, None)
+    return script_file
+
+
+def build_branches(commands):
+    """Splits the commands into branches at #@branch directives and returns them by name.
+
+    A branch continues the pipeline of the branch it forks from, main by default, which holds the commands
+    before the first #@branch. So each branch has the full pipeline up to its last command, and branches share
+    the cached outputs of their common commands."""
+    branches = {MAIN_BRANCH: {"parent": None, "commands": []}}
+    current = branches[MAIN_BRANCH]
+    for command in commands:
+        branch_args = command["directives"].get("branch")
+        if branch_args:
+            name = branch_args[0]
+            if name not in branches:
+                parent = branch_args[2] if branch_args[1:2] == ["from"] and len(branch_args) > 2 else MAIN_BRANCH
+                if parent not in branches:
+                    command["error"] = command["error"] or f"Unknown branch: {parent}"
+                    parent = MAIN_BRANCH
+                branches[name] = {"parent": parent, "commands": list(branches[parent]["commands"])}
+            current = branches[name]
+        current["commands"].append(command)
+
+    for branch in branches.values():
+        hash_commands(branch["commands"])
+    return branches
+
+
+def default_branch(branches):
+    return next((name for name, branch in branches.items() if branch["commands"]), MAIN_BRANCH)
+
+
+def hash_commands(commands):
+    """Sets the cache key of each command.
+
+    The key chains the keys of all previous commands, so a change invalidates the command and all following ones.
+    Besides the command itself, it covers the size and modification time of the files the command depends on."""
     cur_hash = ""
-    block_index = {}
     for command in commands:
-        cur_hash = sha1(cur_hash + command["content"])
+        for part in command["hash_parts"]:
+            cur_hash = sha1(cur_hash + part)
+        if command["deps"]:
+            cur_hash = sha1(cur_hash + fingerprint_files(command["deps"]))
         command["hash"] = cur_hash
-        command["preview"] = make_preview(command["content"])
 
-        marker = command["type"]
-        block_def = BLOCK_DEFS.get(marker)
-        if block_def is not None:
-            index = block_index.get(marker, 0)
-            block_index[marker] = index + 1
 
-            command["script_content"] = command["content"]
+def find_file_candidates(content):
+    """Returns the words and quoted strings in content that could be paths of files the command reads.
 
-            if "mutate_block" in block_def:
-                command["script_content"] = block_def["mutate_block"](command["script_content"])
-                command["preview"] = make_preview(command["script_content"])
+    Files the command writes to are left out, since they would change the command's key on every run."""
+    outputs = find_output_files(content)
+    candidates = []
+    for match in FILE_REFERENCE_PATTERN.finditer(content):
+        candidate = match.group(1) or match.group(2)
+        if candidate not in candidates and candidate not in outputs:
+            candidates.append(candidate)
+    return candidates
 
-            if marker in helpers:
-                command["script_content"] = helpers[marker] + command["script_content"]
-                cur_hash = sha1(cur_hash + helpers[marker])
-                command["hash"] = cur_hash
 
-            spool_file_name = os.path.join(SPOOL_DIR, f"{index}.{marker}")
-            with open(spool_file_name, 'w') as spool_file:
-                spool_file.write(command["script_content"])
-            command["content"] = block_def["build_command"](spool_file_name)
+def find_output_files(content):
+    """Returns the words in content that are files the command writes to, see OUTPUT_FILE_PATTERN."""
+    outputs = []
+    for match in OUTPUT_FILE_PATTERN.finditer(content):
+        if match.group(3) is not None:
+            outputs += [arg.strip("\"'") for arg in match.group(3).split() if not arg.startswith("-")]
+        else:
+            outputs.append(match.group(1) or match.group(2))
+    return outputs
 
-    return commands
+
+def fingerprint_files(file_paths):
+    fingerprint = ""
+    for file_path in file_paths:
+        try:
+            file_stat = os.stat(file_path)
+            fingerprint += f"{file_path}:{file_stat.st_size}:{file_stat.st_mtime_ns}\n"
+        except OSError:
+            fingerprint += f"{file_path}:missing\n"
+    return fingerprint
 
 
 def load_helper_content(file_name):
-    if file_exists(file_name):
+    """Returns the content of a helper file, read again only when its size or modification time changed."""
+    try:
+        file_stat = os.stat(file_name)
+    except FileNotFoundError:
+        return ""
+
+    version = (file_stat.st_size, file_stat.st_mtime_ns)
+    cached = HELPER_CONTENTS.get(file_name)
+    if cached is None or cached[0] != version:
         with open(file_name, 'r') as file:
-            return file.read() + "\n"
-    return ""
+            cached = (version, file.read() + "\n")
+        HELPER_CONTENTS[file_name] = cached
+    return cached[1]
 
 
 def make_preview(content):
     return re.sub(r"\s+", " ", content.strip())
 
 
-def run_commands_and_show_result(commands, up_to_offset=0, force=False):
+class RunCancelled(Exception):
+    pass
+
+
+class RunExecutor:
+    """Runs command runs one at a time on an asyncio event loop in a background thread.
+
+    Submitting a new run kills the processes of the run in flight, waits for it to clean up
+    and then starts the new run. Runs that got superseded while waiting are skipped.
+    Runs execute in pool, which the executors of all daemon clients share, or the loop's default pool if None.
+    They work for the daemon client with the given session settings, see run_session."""
+    def __init__(self, pool=None, session=None):
+        self.pool = pool
+        self.session = session or {}
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.current = None
+        self.latest_request = 0
+
+    def submit(self, func, *args):
+        """Schedules func(run, *args) and returns a concurrent.futures.Future with its result.
+
+        The result is None if the run was cancelled or superseded by a newer one."""
+        self.latest_request += 1
+        return asyncio.run_coroutine_threadsafe(self.run_latest(self.latest_request, func, args), self.loop)
+
+    async def run_latest(self, request, func, args):
+        if self.current is not None:
+            task, run = self.current
+            cancel_run(run)
+            await asyncio.wait([task])
+
+        if request != self.latest_request:
+            return None
+
+        run = new_run(self.session.get("cwd"))
+        task = self.loop.run_in_executor(self.pool, self.call_in_session, func, run, *args)
+        self.current = (task, run)
+        try:
+            return await task
+        except RunCancelled:
+            return None
+
+    def stop(self):
+        if self.current is not None:
+            cancel_run(self.current[1])
+        asyncio.run_coroutine_threadsafe(self.wait_current(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    def call_in_session(self, func, run, *args):
+        # Pool threads work for different clients in turn:
+        SESSION.__dict__.clear()
+        SESSION.__dict__.update(self.session)
+        return func(run, *args)
+
+    async def wait_current(self):
+        if self.current is not None:
+            await asyncio.wait([self.current[0]])
+
+
+def new_run(cwd=None):
+    # fresh holds the hashes of the commands that ran in this run, see with_fresh_outputs:
+    return {"cancelled": False, "procs": [], "lock": threading.Lock(), "cwd": cwd, "fresh": set()}
+
+
+def cancel_run(run):
+    with run["lock"]:
+        run["cancelled"] = True
+        for proc in run["procs"]:
+            kill_process_tree(proc)
+
+
+def kill_process_tree(proc):
+    if proc.poll() is None:
+        try:
+            # Commands run in their own process group, see start_process:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+def start_process(run, args, **kwargs):
+    return register_process(run, subprocess.Popen(args, start_new_session=True, cwd=run["cwd"], **kwargs))
+
+
+def register_process(run, proc):
+    with run["lock"]:
+        run["procs"].append(proc)
+        if run["cancelled"]:
+            kill_process_tree(proc)
+    return proc
+
+
+def run_commands_and_show_result(run, branches, branch, up_to_offset=0, force_from=None):
+    commands = branches[branch]["commands"]
     if not commands:
         print("Waiting for first command...")
         return
 
+    if VIEWPORT is not None:
+        VIEWPORT["status"] = ""
+        show_viewport_file(None)
+
+    # Files the commands depend on might have changed since the last run:
+    for other_branch in branches.values():
+        hash_commands(other_branch["commands"])
+
     up_to = max(0, len(commands) - up_to_offset)
-    success, cmds_ran, last_cmd_index = run_commands(commands, up_to, force)
+    labels = [branch] if len(branches) > 1 else []
+    sample_commands = make_sample_commands(commands, up_to, force_from) if SAMPLE["enabled"] else None
+    stages = []
+    if sample_commands is None:
+        result = run_commands(run, commands, up_to, force_from, stages=stages)
+        print_status(result, commands, up_to, labels, stages)
+    else:
+        result = run_commands(run, sample_commands, up_to, force_from, stages=stages)
+        print_status(result, commands, up_to, labels + ["preview"], stages)
+        result = show_full_result(run, commands, up_to, force_from, labels)
+    tidy_spool()
+
+    if session_setting("prefetch", PREFETCH) and result[0]:
+        prefetch_neighbours(run, commands, up_to)
+        tidy_spool()
+
+    if len(branches) > 1:
+        # Keep the other branches up to date, so switching to them is instant:
+        run_branch_tree(run, branches, MAIN_BRANCH)
+        tidy_spool()
 
+
+def print_status(result, commands, up_to, labels, stages):
+    success, cmds_ran, last_cmd_index = result
+    exceeded = [stage["limit"] for stage in stages if stage["limit"] is not None]
+    labels = labels + [f"{exceeded[-1]} limit"] if exceeded else labels
+    if not success and commands[last_cmd_index].get("error") is not None:
+        labels = labels + [commands[last_cmd_index]["error"]]
     status = "OK" if success else "FAILED"
     status += f" (ran {cmds_ran}/{up_to})\033[0m"
-    status += f" cmd {last_cmd_index + 1}/{len(commands)}: {commands[last_cmd_index]['preview']}"
-    status = ellipsis(status, COLUMNS)
+    status += f" cmd {last_cmd_index + 1}/{len(commands)}"
+    if labels:
+        status += f" ({', '.join(labels)})"
+    status += f": {commands[last_cmd_index]['preview']}"
+    columns = session_setting("columns", COLUMNS)
+    status = ellipsis(status, columns)
 
     # We need to use \r to move cursor to left in terminal raw mode.
     # Cf. https://stackoverflow.com/questions/49124608/how-to-align-the-cursor-to-the-left-side-after-using-printf-c-linux
@@ -238,79 +1109,936 @@ def run_commands_and_show_result(commands, up_to_offset=0, force=False):
         status = "\r\n\033[0;32m" + status
     else:
         status = "\r\n\033[0;31m" + status
+    if STATS:
+        status += "".join("\r\n" + ellipsis(line, columns) for line in format_stages(stages))
+
+    if VIEWPORT is not None:
+        VIEWPORT["status"] = status
 
     print(status, end='', flush=True)
 
 
-def run_commands(commands, up_to, force):
+def format_failure(index, stage):
+    if stage["limit"] is not None:
+        return f"Command {index+1} exceeded its {stage['limit']} limit and was stopped"
+    return f"Command {index+1} failed with return code {stage['exit_status']}"
+
+
+def make_sample_commands(commands, up_to, force_from):
+    """Returns copies of the commands where the commands that need to run get only a sample of their input.
+
+    The copies have their own cache keys, so sampled outputs are cached separately from full ones.
+    Returns None if there's no cached input to sample from or nothing needs to run."""
+    start = find_rerun_start(commands, up_to, force_from)
+    if start in [0, up_to]:
+        return None
+
+    sample_commands = list(commands)
+    for k in range(start, up_to):
+        sample_commands[k] = dict(commands[k], hash=sha1(f"{commands[k]['hash']}:sample:{SAMPLE['lines']}"))
+    sample_commands[start]["sample_lines"] = SAMPLE["lines"]
+    return sample_commands
+
+
+def show_full_result(run, commands, up_to, force_from, labels):
+    """Runs the commands on the full input without showing their output, then replaces the preview with the result."""
+    stages = []
+    result = run_commands(run, commands, up_to, force_from, show=False, stages=stages)
     clear_terminal()
+    success, _, last_cmd_index = result
+    if success:
+        show_output_file(find_shown_output_file(commands[last_cmd_index]))
+    else:
+        print(f"Command {last_cmd_index + 1} failed on the full input")
+    print_status(result, commands, up_to, labels, stages)
+    return result
+
+
+def prefetch_neighbours(run, commands, up_to):
+    """Caches the colored outputs of the commands next to the shown one and of the first and last command.
+
+    So moving there with up/down/home/end only reads the cache. This includes running the commands after the shown
+    one. Runs while the user looks at the result and gets cancelled by the next key press like any other run."""
+    for target in dict.fromkeys([up_to - 1, up_to + 1, len(commands), 1]):
+        if 0 < target <= len(commands) and target != up_to:
+            # Its colored output could take another run of a command that may have side effects or be expensive,
+            # see with_fresh_outputs and find_shown_output_file:
+            if {"always", "ttl", "pin"} & set(commands[target - 1]["directives"]):
+                continue
+            success, _, _ = run_commands(run, commands, target, None, show=False)
+            if not success:
+                break
+
 
+def run_branch_tree(run, branches, name):
+    """Runs the branch without showing its output, then the branches forking from it in parallel."""
+    commands = branches[name]["commands"]
+    success, _, _ = run_commands(run, commands, len(commands), None, show=False)
+    children = [child for child, branch in branches.items() if branch["parent"] == name]
+    if not success or not children:
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(children)) as pool:
+        for future in [pool.submit(run_branch_tree, run, branches, child) for child in children]:
+            future.result()
+
+
+def run_commands(run, commands, up_to, force_from, show=True, *, stages=None, plain=False):  # pylint: disable=too-many-arguments
+    """Runs the commands up to up_to, or uses their cached outputs, and shows the output of the last one.
+
+    Returns whether all commands succeeded, how many ran and the index of the last or failed command.
+    The stats of each command are added to stages if given, see new_stage. If plain is True, only the plain output
+    of the last command is needed, so it runs like the others instead of in a pty, and isn't shown."""
+    stages = [] if stages is None else stages
+    commands = with_fresh_outputs(run, commands)
+    if show:
+        clear_terminal()
+
+    k = find_invalid_command(commands, up_to)
+    if k is not None:
+        if show:
+            print(f"Command {k+1} has an invalid directive: {commands[k]['error']}")
+        return False, 0, k
+
+    if STREAM and show:
+        return run_commands_streaming(run, commands, up_to, force_from, stages)
+
+    start = find_rerun_start(commands, up_to, force_from, need_col=not plain)
     cmds_ran = 0
     for k, command in enumerate(commands[:up_to]):
-        last = k == up_to - 1
-        stdin_file_path = get_output_file(commands[k - 1]) if k > 0 else None
-        out_file_path = get_output_file(command)
-        col_file_path = get_col_output_file(command)
-        stdout_file_path = col_file_path if last else out_file_path
-
-        if not last and not file_exists(out_file_path) and file_exists(col_file_path):
-            convert_col_to_out_file(col_file_path, out_file_path)
+        # The colored output is only needed for the last command:
+        last = k == up_to - 1 and not plain
 
         # Command executed previously, use cached output:
-        if not force and file_exists(stdout_file_path):
-            # Touch cached file so housekeeping knows it was used recently:
-            Path(stdout_file_path).touch()
-            if last:
-                with open(stdout_file_path, 'rb') as file:
-                    print(file.read().decode("utf8"))
+        if k < start:
+            use_cached_output(stages, command, k, last, show)
             continue
 
-        cmds_ran += 1
+        lock = lock_command(run, commands, k, force_from, last)
+        if lock is None:
+            # Another peepo instance ran the command while we waited for it:
+            use_cached_output(stages, command, k, last, show)
+            continue
+
+        with lock:
+            outputs = get_last_outputs(commands, up_to, force_from, start) if last else ["out"]
+            if adopt_cached_outputs(commands, k, force_from, outputs):
+                # The command before reran with the same output as before:
+                use_cached_output(stages, command, k, last, show)
+                run["fresh"].add(command["hash"])
+                continue
+
+            cmds_ran += 1
+            stage = new_stage(command, k, cached=False)
+            # The next python block takes the object of a python block, so it only prints it if shown:
+            command = with_object_env(commands, k, text=k == up_to - 1 or commands[k + 1]["type"] != "py")
+            run_command_to_spool(run, command, open_input(commands, k), outputs, echo=show, stage=stage)
+
+            if run["cancelled"]:
+                # The old output is outdated, the partial output of the killed command was never committed:
+                remove_command_outputs(command, outputs)
+                raise RunCancelled()
 
-        with open(stdout_file_path, 'wb') as stdout_file:
-            return_code = run_command(command["content"], stdin_file_path, stdout_file, use_color=last)
+            finish_stage(stages, stage)
 
-        acceptable_return_codes = [0]
-        if is_grep_command(command["content"]):
-            acceptable_return_codes = [0, 1]
+            if not is_successful(command, stage["exit_status"], stage):
+                remove_output_files([command])
+                if show:
+                    print(format_failure(k, stage))
+                return False, cmds_ran, k
 
-        if return_code not in acceptable_return_codes:
-            os.remove(stdout_file_path)
-            print(f"Command {k+1} failed with return code {return_code}")
-            return False, cmds_ran, k
+            record_input_key(commands, k)
+            run["fresh"].add(command["hash"])
+            if last and show:
+                show_ran_output_file(find_spool_file(get_col_output_file(command)))
 
     return True, cmds_ran, up_to - 1
 
 
-def convert_col_to_out_file(col_file_path, out_file_path):
-    with open(out_file_path, 'w') as out_file:
-        with open(col_file_path, 'r') as col_file:
-            for line in col_file:
-                out_file.write(strip_ansi_escape_codes(line))
+def find_invalid_command(commands, up_to):
+    """Returns the index of the first command up to up_to with an invalid directive, see parse_directive, or None."""
+    return next((k for k, command in enumerate(commands[:up_to]) if command.get("error") is not None), None)
 
 
-def is_grep_command(cmd_content):
-    return re.search(r"^\s*e?grep", cmd_content)
+def with_fresh_outputs(run, commands):
+    """Returns the commands, with those that already ran in the run without the directives that make them rerun.
+
+    So running more commands in the same run, like prefetch_neighbours and run_branch_tree do, doesn't rerun
+    #@always or expired #@ttl commands whose outputs were just made."""
+    fresh_commands = []
+    for command in commands:
+        if command["hash"] in run["fresh"]:
+            directives = {name: args for name, args in command["directives"].items() if name not in ["always", "ttl"]}
+            command = dict(command, directives=directives)
+        fresh_commands.append(command)
+    return fresh_commands
+
+
+def lock_command(run, commands, index, force_from, last):
+    """Takes the exclusive lock of the command at index to run it, see SpoolLock, and returns it.
 
+    Returns None instead if another peepo instance ran the command while waiting for the lock,
+    so its cached output can be used."""
+    lock = SpoolLock(commands[index]["hash"], run=run)
+    lock.acquire()
+    if lock.waited and find_rerun_start(commands, index + 1, force_from, need_col=last) == index + 1:
+        lock.release()
+        return None
+    return lock
 
-def run_command(cmd, stdin_file_path, stdout_file, use_color):
-    if use_color:
 
-        def read(pty_stdout):
-            data = os.read(pty_stdout, 1024)
-            stdout_file.write(data)
-            return data
+def use_cached_output(stages, command, index, last, show):
+    """Uses the cached output of a command that doesn't need to run and adds its stats to stages.
+
+    The cached output of the last command is the colored one, which is shown unless show is False."""
+    with SpoolLock(command["hash"], exclusive=False, blocking=False):
+        cached_file_path = find_shown_output_file(command) if last else find_spool_file(get_output_file(command))
+        if cached_file_path is not None:
+            # Touch cached file so housekeeping knows it was used recently:
+            touch_spool_file(cached_file_path)
+        if last and show:
+            show_output_file(cached_file_path)
+
+        try:
+            bytes_out = os.path.getsize(cached_file_path) if cached_file_path is not None else 0
+        except FileNotFoundError:
+            bytes_out = 0
+    finish_stage(stages, new_stage(command, index, cached=True), bytes_out=bytes_out)
+
+
+def find_shown_output_file(command):
+    """Returns the cached colored output of the command, or its plain output if it only has that and is pinned.
+
+    A pinned command isn't rerun just to get its colored output, see find_rerun_start."""
+    col_file_path = find_spool_file(get_col_output_file(command))
+    if col_file_path is None and "pin" in command.get("directives", {}):
+        return find_spool_file(get_output_file(command))
+    return col_file_path
+
+
+def get_input_key(commands, index):
+    """Returns a cache key of the command at index that covers what it runs on instead of the commands before it.
+
+    Like the key of hash_commands, it covers the command and the files it depends on, but then the hash of its input,
+    the cached output of the command before it, instead of the keys of the commands before.
+    Returns None if the input is unknown, without --cutoff, for the first command, a command that gets a sample of its
+    input or a python block that gets an object."""
+    command = commands[index]
+    if not CUTOFF or index == 0 or "sample_lines" in command:
+        return None
+    if command["type"] == "py" and find_spool_file(get_object_file(commands[index - 1])) is not None:
+        return None
+    name = os.path.basename(get_output_file(commands[index - 1]))
+    rows = query_manifest("SELECT output_hash FROM entries WHERE name IN (?, ?)", (name, name + GZIP_SUFFIX))
+    if not rows or rows[0][0] is None:
+        return None
+
+    key = rows[0][0]
+    for part in command["hash_parts"]:
+        key = sha1(key + part)
+    if command["deps"]:
+        key = sha1(key + fingerprint_files(command["deps"]))
+    return key
+
+
+def record_input_key(commands, index):
+    """Records the input key of the command at index with its outputs, see get_input_key."""
+    key = get_input_key(commands, index)
+    if key is not None:
+        query_manifest("UPDATE entries SET input_key = ? WHERE name IN (?, ?, ?, ?, ?)",
+                       [key] + get_output_names(commands[index]))
+
+
+def adopt_cached_outputs(commands, index, force_from, outputs):
+    """Uses the cached outputs of a command with the same input key as the outputs of the command at index.
+
+    This cuts off reruns early: if a changed command's output is the same as before, the commands after it
+    get the same input as before, so their outputs from before are still valid even though their keys changed.
+    The outputs are hard links to the earlier ones. Returns whether there were all the given outputs to adopt."""
+    key = get_input_key(commands, index)
+    if key is None or is_cache_outdated(commands[index], index, force_from, None):
+        return False
+    rows = query_manifest("SELECT name, exit_status, output_hash FROM entries WHERE input_key = ? ORDER BY created DESC", (key, ))
+    if not rows:
+        return False
+
+    # Take the outputs of the latest command with that input key:
+    source_hash = rows[0][0].split(".")[0]
+    rows = [row for row in rows if row[0].split(".")[0] == source_hash]
+    if not all(any(name.split(".")[1] == output for name, *_ in rows) for output in outputs):
+        return False
+
+    if source_hash == commands[index]["hash"]:
+        # Another peepo instance ran the command in the meantime:
+        return True
+
+    with SpoolLock(source_hash, exclusive=False, blocking=False):
+        for name, exit_status, output_hash in rows:
+            target_path = os.path.join(SPOOL_DIR, commands[index]["hash"] + name[len(source_hash):])
+            temp_path = f"{target_path}.{os.getpid()}.{threading.get_ident()}{TEMP_SUFFIX}"
+            try:
+                os.link(os.path.join(SPOOL_DIR, name), temp_path)
+            except FileNotFoundError:
+                return False
+            os.replace(temp_path, target_path)
+            record_spool_file(target_path, 0, exit_status, output_hash)
+    record_input_key(commands, index)
+    return True
+
+
+def get_last_outputs(commands, up_to, force_from, start):
+    """Returns the outputs to write for the last command to run, see run_command_to_spool.
+
+    If the last command only reruns to get its colored output, its plain output is still valid and is kept,
+    so the commands after it don't count as outdated."""
+    if start == up_to - 1 and find_rerun_start(commands, up_to, force_from, need_col=False) == up_to:
+        return ["col"]
+    return ["col", "out"]
+
+
+def run_command_to_spool(run, command, stdin, outputs, echo=True, *, stage=None):  # pylint: disable=too-many-arguments
+    """Runs the command with its output written to the spool and closes stdin when done.
+
+    outputs lists the spool files to write: "col" for the colored output, which is also echoed to the terminal
+    unless echo is False, and "out" for the plain output.
+    Returns the exit code of the command and adds its resource usage and output size to stage if given, see new_stage."""
+    started = time.monotonic()
+    command, object_file = open_object_writer(command)
+    if "col" in outputs:
+        # Capture the colored output for the terminal and the plain output for following commands in one go:
+        with open_spool_writer(get_col_output_file(command)) as col_file, \
+                (open_spool_writer(get_output_file(command)) if "out" in outputs else open(os.devnull, 'wb')) as out_file:
+            return_code, usage = run_command(run, command, stdin, col_file, plain_file=out_file, echo=echo)
+            # Sizes before compression:
+            bytes_out = out_file.tell() if "out" in outputs else col_file.tell()
+        written_files = [col_file, out_file] if "out" in outputs else [col_file]
+    else:
+        # Colored output from when the command was shown last is outdated now:
+        remove_spool_file(get_col_output_file(command))
+        with open_spool_writer(get_output_file(command)) as out_file:
+            return_code, usage = run_command(run, command, stdin, out_file)
+            bytes_out = out_file.tell()
+        written_files = [out_file]
+
+    if stdin is not None:
+        stdin.close()
+    if object_file is not None:
+        written_files.append(object_file)
+    for file in written_files:
+        # The output of a command that exceeded a limit is cut off, so it's discarded like that of a failed one:
+        if run["cancelled"] or not is_successful(command, return_code, usage) \
+                or not is_output_written(command, file, object_file):
+            discard_spool_file(file)
+        else:
+            commit_spool_file(file, time.monotonic() - started, return_code)
+    if stage is not None:
+        stage.update(usage, bytes_out=bytes_out, exit_status=return_code, wall_seconds=time.time() - stage["started"])
+    return return_code
+
+
+def with_object_env(commands, index, text=True):
+    """Returns the command at index, if it's a python block with the environment to hand objects between python blocks.
+
+    The block gets the object that the block before handed over, see to_object in helpers.py.tmpl. Unless text
+    is True, the block only hands its own object to the next block and doesn't print it, see is_output_written."""
+    command = commands[index]
+    if command["type"] != "py":
+        return command
+    env = {"PEEPO_TEXT": "1" if text else "0"}
+    object_file_path = find_spool_file(get_object_file(commands[index - 1])) if index > 0 else None
+    if object_file_path is not None:
+        env["PEEPO_OBJ_IN"] = object_file_path
+    return dict(command, env=env)
+
+
+def open_object_writer(command):
+    """Returns the command with the path to write the object it hands over to in its environment, see with_object_env,
+    and the spool writer of the object. Returns the command as is and None if it doesn't hand over objects."""
+    if "env" not in command:
+        return command, None
+    object_file = open_spool_writer(get_object_file(command), compress=False)
+    # The block opens the file by its path, so its content isn't hashed:
+    object_file.close()
+    object_file.hasher = None
+    return dict(command, env=dict(command["env"], PEEPO_OBJ_OUT=object_file.name)), object_file
+
+
+def is_output_written(command, file, object_file):
+    """Returns whether a spool file written by a command holds its output.
+
+    The object file is empty if the block didn't hand over an object, and the plain output is if the block
+    handed over an object without printing it."""
+    if object_file is None:
+        return True
+    handed_over = os.path.getsize(object_file.name) > 0
+    if file is object_file:
+        return handed_over
+    return not handed_over or command["env"]["PEEPO_TEXT"] != "0"
+
+
+def has_object_for_next(commands, index, up_to):
+    """Returns whether the command handed an object to the next command up to up_to, which then needs no plain output."""
+    return (index < up_to - 1 and commands[index + 1]["type"] == "py"
+            and find_spool_file(get_object_file(commands[index])) is not None)
+
+
+def run_commands_streaming(run, commands, up_to, force_from, stages):
+    start, locks = lock_stream_commands(run, commands, up_to, force_from)
+    try:
+        return run_locked_commands_streaming(run, commands, up_to, force_from, stages, start=start)
+    finally:
+        for lock in locks:
+            lock.release()
+
+
+def lock_stream_commands(run, commands, up_to, force_from):
+    """Takes the exclusive locks of the commands to run as one pipeline, see SpoolLock.
+
+    Returns the index of the first command to run and the locks. If another peepo instance ran some of the commands
+    while waiting for their locks, the commands to run are worked out again."""
+    while True:
+        start = find_rerun_start(commands, up_to, force_from)
+        locks = []
+        try:
+            # Always in the same order, so two instances never wait for each other's locks:
+            for command in commands[start:up_to]:
+                lock = SpoolLock(command["hash"], run=run)
+                lock.acquire()
+                locks.append(lock)
+        except RunCancelled:
+            for lock in locks:
+                lock.release()
+            raise
+
+        if not any(lock.waited for lock in locks) or find_rerun_start(commands, up_to, force_from) == start:
+            return start, locks
+        for lock in locks:
+            lock.release()
+
+
+def run_locked_commands_streaming(run, commands, up_to, force_from, stages, *, start):  # pylint: disable=too-many-arguments
+    last_outputs = get_last_outputs(commands, up_to, force_from, start)
+
+    last_k = up_to - 1
+    for k in range(start):
+        use_cached_output(stages, commands[k], k, k == last_k, show=True)
+    if start == up_to:
+        return True, 0, last_k
+
+    # Stages hand their output on as text, only the first can take an object from the cache:
+    commands = commands[:start] + [with_object_env(commands, start)] + commands[start + 1:]
+    stream_stages, stdin = start_stream_stages(run, commands[start:last_k], open_input(commands, start), start)
+    last_stage = new_stage(commands[last_k], last_k, cached=False)
+    run_command_to_spool(run, commands[last_k], stdin, last_outputs, stage=last_stage)
+    for stream_stage in stream_stages:
+        finish_stream_stage(run, stream_stage)
+
+    if run["cancelled"]:
+        remove_output_files(commands[start:last_k])
+        remove_command_outputs(commands[last_k], last_outputs)
+        raise RunCancelled()
+
+    ran_stages = [stream_stage["stats"] for stream_stage in stream_stages] + [last_stage]
+    for stage in ran_stages:
+        finish_stage(stages, stage)
+
+    show_ran_output_file(find_spool_file(get_col_output_file(commands[last_k])))
+
+    for k, stage in enumerate(ran_stages, start):
+        if not is_successful(commands[k], stage["exit_status"], stage):
+            # Downstream commands only saw partial input, so their outputs are invalid too:
+            remove_output_files(commands[k:up_to])
+            print(format_failure(k, stage))
+            return False, up_to - start, k
+
+    for k in range(start, up_to):
+        record_input_key(commands, k)
+        run["fresh"].add(commands[k]["hash"])
+    return True, up_to - start, last_k
+
+
+def open_cached_stdin(command, sample_lines=None):
+    """Opens the cached output of command as stdin for the next command, or only its first sample_lines lines."""
+    with SpoolLock(command["hash"], exclusive=False, blocking=False):
+        stdin_file_path = find_spool_file(get_output_file(command))
+        touch_spool_file(stdin_file_path)
+        if sample_lines is None:
+            return open_spool_stdin(stdin_file_path)
+        reader = open_spool_reader(stdin_file_path)
+
+    stdin, sink = os.pipe()
+    threading.Thread(target=pump_lines_to_fd, args=(reader, sink, sample_lines), daemon=True).start()
+    return os.fdopen(stdin, 'rb')
+
+
+def open_input(commands, index):
+    """Opens the stdin of the command at index, the cached output of the command before it, or returns None."""
+    if index == 0:
+        return None
+    if find_spool_file(get_output_file(commands[index - 1])) is None:
+        # The block before only handed an object to this one, see with_object_env:
+        return open(os.devnull, 'rb')
+    return open_cached_stdin(commands[index - 1], commands[index].get("sample_lines"))
+
+
+def start_stream_stages(run, commands, stdin, first_index):
+    """Starts the commands piped together and returns the running stages and the stdin for the next command."""
+    stages = []
+    for index, command in enumerate(commands, first_index):
+        remove_spool_file(get_col_output_file(command))
+        stdout_file = open_spool_writer(get_output_file(command))
+        proc = start_command(run, command, stdin=stdin, stdout=subprocess.PIPE)
+        if stdin is not None:
+            stdin.close()
+
+        # Tee the command's output into its spool file and into the pipe to the next command:
+        next_stdin, sink = os.pipe()
+        stage = {
+            "proc": proc,
+            "limiter": CommandLimiter(command, proc, stdout_file),
+            "command": command,
+            "stdout_file": stdout_file,
+            "started": time.monotonic(),
+            "stats": new_stage(command, index, False)
+        }
+        stage["tee"] = threading.Thread(target=tee_stage_output, args=(stage, sink), daemon=True)
+        stage["tee"].start()
+        stdin = os.fdopen(next_stdin, 'rb')
+        stages.append(stage)
+
+    return stages, stdin
+
+
+def tee_stage_output(stage, sink):
+    tee_output(stage["proc"].stdout, stage["stdout_file"], sink)
+    # The command is only waited for once the last command is done, but its output ends when it exits:
+    stage["stats"]["wall_seconds"] = time.time() - stage["stats"]["started"]
+
+
+def finish_stream_stage(run, stage):
+    return_code, usage = wait_limited(stage["proc"], stage["limiter"])
+    stage["tee"].join()
+    stage["stats"].update(usage, bytes_out=stage["stdout_file"].tell(), exit_status=return_code)
+    if run["cancelled"] or not is_successful(stage["command"], return_code, usage):
+        discard_spool_file(stage["stdout_file"])
+    else:
+        commit_spool_file(stage["stdout_file"], time.monotonic() - stage["started"], return_code)
+
+
+def new_stage(command, index, cached):
+    """Returns the stats of running a command or using its cached output, completed by finish_stage."""
+    return {
+        "cmd": index + 1,
+        "preview": command["preview"],
+        "hash": command["hash"],
+        "cached": cached,
+        "sampled": "sample_lines" in command,
+        "started": time.time(),
+        "wall_seconds": None,
+        "cpu_seconds": None,
+        "max_rss_bytes": None,
+        "bytes_in": None,
+        "bytes_out": None,
+        "exit_status": None,
+        "limit": None,
+    }
 
-        if stdin_file_path:
-            cmd = f"cat {stdin_file_path} | {cmd}"
 
-        return pty.spawn(build_bash_cmd(cmd), read)
+def finish_stage(stages, stage, **stats):
+    """Completes the stats of a command and adds them to stages, the stats of the commands before it, and the trace file."""
+    stage.update(stats)
+    if stage["wall_seconds"] is None:
+        stage["wall_seconds"] = time.time() - stage["started"]
+    # A sample of the input is smaller than the output of the command before:
+    if not stage["sampled"]:
+        stage["bytes_in"] = stages[-1]["bytes_out"] if stages else 0
+    stages.append(stage)
+    write_trace(stage)
 
-    stdin_file = open(stdin_file_path, 'rb') if stdin_file_path is not None else None
-    result = subprocess.run(build_bash_cmd(cmd), stdout=stdout_file, stdin=stdin_file, check=False)
-    if stdin_file is not None:
-        stdin_file.close()
-    return result.returncode
+
+def format_stages(stages):
+    lines = [f"{'cmd':>4} {'cache':<5} {'wall':>8} {'cpu':>8} {'rss':>6} {'in':>6} {'out':>6}"]
+    for stage in stages:
+        lines.append(f"{stage['cmd']:>4} {'hit' if stage['cached'] else 'miss':<5} "
+                     f"{format_seconds(stage['wall_seconds']):>8} {format_seconds(stage['cpu_seconds']):>8} "
+                     f"{format_size(stage['max_rss_bytes']):>6} {format_size(stage['bytes_in']):>6} "
+                     f"{format_size(stage['bytes_out']):>6}")
+    return lines
+
+
+def format_seconds(seconds):
+    return "-" if seconds is None else f"{seconds:.3f}s"
+
+
+def format_size(size):
+    if size is None:
+        return "-"
+    unit = next(unit for unit in reversed(SIZE_UNITS) if size >= SIZE_UNITS[unit] or unit == "")
+    return f"{size / SIZE_UNITS[unit]:.1f}{unit}" if unit else str(size)
+
+
+def open_trace(file_path, trace_format):
+    global TRACE  # pylint: disable=global-statement
+    if trace_format not in ["jsonl", "chrome"]:
+        raise ValueError(f"Invalid trace format: {trace_format}")
+    TRACE = {"file": open(file_path, 'w'), "format": trace_format, "lock": threading.Lock()}
+    if trace_format == "chrome":
+        # The format allows leaving the array unterminated, so events can be appended until peepo exits:
+        TRACE["file"].write("[\n")
+
+
+def write_trace(stage):
+    if TRACE is None:
+        return
+    if TRACE["format"] == "chrome":
+        event = {
+            "name": f"cmd {stage['cmd']}: {stage['preview']}",
+            "cat": "cached" if stage["cached"] else "ran",
+            "ph": "X",
+            "ts": stage["started"] * 1e6,
+            "dur": stage["wall_seconds"] * 1e6,
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": stage,
+        }
+        line = json.dumps(event) + ",\n"
+    else:
+        line = json.dumps(stage) + "\n"
+    with TRACE["lock"]:
+        TRACE["file"].write(line)
+        TRACE["file"].flush()
+
+
+def find_rerun_start(commands, up_to, force_from, need_col=True):
+    """Returns the index of the first command to run. The commands before it use their cached output.
+
+    A command reruns if it has no cached output, if its cache policy or force_from say so, or if the command
+    before it reran, now or since the cached output was created. Pinned commands keep their cached output in any case.
+    The last command also reruns if it only has plain output, unless need_col is False or it is pinned,
+    see find_shown_output_file."""
+    start = 0
+    rerun = False
+    input_created = None
+    for k, command in enumerate(commands[:up_to]):
+        if k == up_to - 1 and need_col and "pin" not in command.get("directives", {}):
+            cached = find_spool_file(get_col_output_file(command)) is not None
+        else:
+            cached = ensure_out_file(command) or has_object_for_next(commands, k, up_to)
+
+        created = get_output_created(command) if cached else None
+        outdated = rerun or is_cache_outdated(command, k, force_from, created)
+        if input_created is not None and created is not None and created < input_created:
+            outdated = True
+
+        if cached and ("pin" in command.get("directives", {}) or not outdated):
+            start = k + 1
+            rerun = False
+        else:
+            rerun = True
+        input_created = created
+
+    return start
+
+
+def is_cache_outdated(command, index, force_from, created):
+    directives = command.get("directives", {})
+    if "always" in directives or (force_from is not None and index >= force_from):
+        return True
+    if "ttl" in directives:
+        return created is None or time.time() - created > parse_duration(directives["ttl"][0])
+    return False
+
+
+def tee_output(src, stdout_file, sink):
+    # Keep spooling even if the next command stops reading early (e.g. head),
+    # so the cached output is always complete.
+    sink_open = True
+    while True:
+        data = src.read1(PIPE_BUFFER_SIZE)
+        if not data:
+            break
+        stdout_file.write(data)
+        if sink_open:
+            try:
+                write_fully(sink, data)
+            except BrokenPipeError:
+                sink_open = False
+    src.close()
+    os.close(sink)
+
+
+def pump_to_fd(src, sink):
+    while True:
+        data = src.read(PIPE_BUFFER_SIZE)
+        if not data:
+            break
+        try:
+            write_fully(sink, data)
+        except BrokenPipeError:
+            break
+    src.close()
+    os.close(sink)
+
+
+def pump_lines_to_fd(src, sink, max_lines):
+    try:
+        for line in itertools.islice(src, max_lines):
+            write_fully(sink, line)
+    except BrokenPipeError:
+        pass
+    src.close()
+    os.close(sink)
+
+
+def write_fully(fd, data):
+    view = memoryview(data)
+    while view:
+        written = os.write(fd, view)
+        view = view[written:]
+
+
+def remove_output_files(commands):
+    for command in commands:
+        remove_command_outputs(command, ["col", "out"])
+        remove_spool_file(get_object_file(command))
+
+
+def remove_command_outputs(command, outputs):
+    if "out" in outputs:
+        remove_spool_file(get_output_file(command))
+    if "col" in outputs:
+        remove_spool_file(get_col_output_file(command))
+
+
+def ensure_out_file(command):
+    """Makes sure the command's uncolored output exists if any output is cached. Returns whether it exists."""
+    out_file_path = get_output_file(command)
+    if find_spool_file(out_file_path) is not None:
+        return True
+
+    col_file_path = find_spool_file(get_col_output_file(command))
+    if col_file_path is None:
+        return False
+
+    convert_col_to_out_file(col_file_path, out_file_path)
+    return True
+
+
+def convert_col_to_out_file(col_file_path, out_file_path):
+    # Colored and plain outputs are captured together nowadays, this is only needed if the plain output
+    # was evicted or the colored output was captured by an older peepo version.
+    with open_spool_writer(out_file_path) as out_file:
+        with open_spool_reader(col_file_path) as col_file:
+            for line in col_file:
+                out_file.write(strip_ansi_escape_codes(line).replace(b"\r\n", b"\n"))
+    commit_spool_file(out_file, 0, 0)
+
+
+def is_grep_command(cmd_content):
+    return re.search(r"^\s*e?grep", cmd_content)
+
+
+def is_acceptable_return_code(command, return_code):
+    acceptable_return_codes = [0]
+    if is_grep_command(command["content"]):
+        acceptable_return_codes = [0, 1]
+    return return_code in acceptable_return_codes
+
+
+def is_successful(command, return_code, usage):
+    """Returns whether the command exited with an acceptable return code without exceeding a limit, see wait_limited."""
+    return is_acceptable_return_code(command, return_code) and usage.get("limit") is None
+
+
+def get_limits(command):
+    """Returns the limits of the command, LIMITS with those of its #@limit directives, e.g. "#@limit time=30s"."""
+    return dict(LIMITS, **parse_limits(command.get("directives", {}).get("limit", [])))
+
+
+class CommandLimiter:
+    """Kills a running command once it runs longer or writes more output than its limits allow, see get_limits.
+
+    The CPU time and memory limits are set on the command's processes instead, see with_resource_limits."""
+    def __init__(self, command, proc, stdout_file):
+        self.limits = get_limits(command)
+        self.proc = proc
+        self.bytes_out = 0
+        self.exceeded = None
+        self.timer = None
+        if self.limits["output"] is not None:
+            stdout_file.limiter = self
+        if self.limits["time"] is not None:
+            self.timer = threading.Timer(self.limits["time"], self.kill, args=["time"])
+            self.timer.daemon = True
+            self.timer.start()
+
+    def add_output(self, size):
+        self.bytes_out += size
+        if self.bytes_out > self.limits["output"] and self.exceeded is None:
+            self.kill("output")
+
+    def kill(self, limit):
+        self.exceeded = limit
+        kill_process_tree(self.proc)
+
+    def finish(self, return_code):
+        """Stops watching the command and returns the name of the limit it exceeded, or None."""
+        if self.timer is not None:
+            self.timer.cancel()
+        # The kernel stops processes that exceed their CPU time with SIGXCPU, bash reports that as 128 + SIGXCPU:
+        if self.limits["cpu"] is not None and return_code in [-signal.SIGXCPU, 128 + signal.SIGXCPU]:
+            self.exceeded = self.exceeded or "cpu"
+        return self.exceeded
+
+
+def run_command(run, command, stdin, stdout_file, plain_file=None, *, echo=True):  # pylint: disable=too-many-arguments
+    """Runs the command with its output written to stdout_file.
+
+    If plain_file is given, the command runs in a pty to get colored output, which is also echoed to the terminal
+    unless echo is False. The output without colors goes to plain_file.
+    Returns the exit code and resource usage of the command, see wait_limited."""
+    if plain_file is not None:
+        return run_pty_command(run, command, stdin, stdout_file, plain_file, echo=echo)
+
+    if stdout_file.hasher is None and get_limits(command)["output"] is None and not isinstance(stdout_file.file, gzip.GzipFile):
+        # Nothing to do on the way to the spool file, so the command writes to it directly:
+        proc = start_command(run, command, stdout=stdout_file.file, stdin=stdin)
+        return wait_limited(proc, CommandLimiter(command, proc, stdout_file))
+
+    # The output passes through peepo to be hashed, counted or compressed on the way to the spool file:
+    proc = start_command(run, command, stdout=subprocess.PIPE, stdin=stdin)
+    limiter = CommandLimiter(command, proc, stdout_file)
+    if hasattr(fcntl, "F_SETPIPE_SZ"):
+        # Fewer, larger reads, since the data is copied anyway:
+        fcntl.fcntl(proc.stdout.fileno(), fcntl.F_SETPIPE_SZ, SPOOL_COPY_SIZE)
+    shutil.copyfileobj(proc.stdout, stdout_file, SPOOL_COPY_SIZE)
+    proc.stdout.close()
+    return wait_limited(proc, limiter)
+
+
+def wait_command(proc):
+    """Waits for the command to exit and returns its exit code and resource usage.
+
+    The usage is a dict with the CPU time and peak memory of the command and the processes it waited for,
+    or None if unknown."""
+    if not isinstance(proc, subprocess.Popen):
+        return proc.wait(), proc.usage
+    try:
+        _, status, usage = os.wait4(proc.pid, 0)
+    except ChildProcessError:
+        # Already reaped by a poll when the run got cancelled:
+        return proc.wait(), None
+    proc.returncode = exit_code_of_status(status)
+    return proc.returncode, usage_of(usage)
+
+
+def wait_limited(proc, limiter):
+    """Like wait_command, but the usage is always a dict, and its "limit" is the limit the command exceeded or None."""
+    return_code, usage = wait_command(proc)
+    return return_code, dict(usage or {}, limit=limiter.finish(return_code))
+
+
+def usage_of(rusage):
+    # ru_maxrss is in kilobytes on Linux:
+    return {"cpu_seconds": rusage.ru_utime + rusage.ru_stime, "max_rss_bytes": rusage.ru_maxrss * 1024}
+
+
+def exit_code_of_status(status):
+    return os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+
+
+def start_command(run, command, **kwargs):
+    if "script_file" in command:
+        # Brings the block's script back if tidy_spool removed it since the block was prepared:
+        write_block_script(command["type"], command["script_content"])
+    command = with_resource_limits(command)
+    if WARM_BLOCKS:
+        start_warm = BLOCK_DEFS.get(command["type"], {}).get("start_warm", bash_start_warm)
+        return start_warm(run, command, **kwargs)
+    if "env" in command:
+        kwargs["env"] = {**os.environ, **command["env"]}
+    return start_process(run, build_bash_cmd(command["content"]), **kwargs)
+
+
+def with_resource_limits(command):
+    """Returns the command with the CPU time and memory limits of its processes set by ulimit before it runs.
+
+    Python blocks in the resident python server set them themselves, see run_python_block."""
+    limits = get_limits(command)
+    ulimits = []
+    if limits["cpu"] is not None:
+        # Past the soft limit, processes get SIGXCPU, which tells the exceeded limit apart from other kills:
+        ulimits += [f"ulimit -S -t {limits['cpu']}", f"ulimit -H -t {limits['cpu'] + 1}"]
+    if limits["memory"] is not None:
+        # In kilobytes:
+        ulimits.append(f"ulimit -v {limits['memory'] // 1024}")
+    if not ulimits:
+        return command
+    return dict(command, content="\n".join(ulimits + [command["content"]]))
+
+
+def run_pty_command(run, command, stdin, stdout_file, plain_file, *, echo=True):  # pylint: disable=too-many-arguments
+    """Runs cmd with its stdout attached to a pseudo-terminal so it produces colored output.
+
+    The output is written both to stdout_file and the terminal, and without ANSI escape codes
+    to plain_file in the same pass.
+    stdin can be any file object or None, in which case the command gets no input."""
+    master, slave = pty.openpty()
+    # Without output post-processing the kernel passes output through in blocks instead of byte by byte
+    # to translate \n to \r\n, which more than doubles throughput. We translate when echoing instead,
+    # see to_terminal_newlines.
+    attrs = termios.tcgetattr(slave)
+    attrs[1] &= ~termios.OPOST
+    termios.tcsetattr(slave, termios.TCSANOW, attrs)
+    proc = start_command(run, command, stdin=stdin if stdin is not None else subprocess.DEVNULL, stdout=slave, stderr=slave)
+    limiter = CommandLimiter(command, proc, stdout_file)
+    os.close(slave)
+
+    # In viewport mode, the output is shown from the spool file once the command finished:
+    echo = echo and VIEWPORT is None
+    stripper = AnsiEscapeStripper()
+    sys.stdout.flush()
+    while True:
+        try:
+            data = os.read(master, PIPE_BUFFER_SIZE)
+        except OSError:
+            # Linux raises EIO once the last process holding the pty closed it.
+            break
+        if not data:
+            break
+        stdout_file.write(data)
+        plain_file.write(stripper.feed(data))
+        if echo:
+            write_fully(sys.stdout.fileno(), data.replace(b"\n", b"\r\n"))
+
+    plain_file.write(stripper.flush())
+    os.close(master)
+    return wait_limited(proc, limiter)
+
+
+class AnsiEscapeStripper:
+    """Strips ANSI escape codes from a byte stream that arrives in chunks.
+
+    An escape sequence can be split across two chunks, so an unfinished one at the end
+    of a chunk is held back until the next chunk arrives."""
+    def __init__(self):
+        self.pending = b""
+
+    def feed(self, data):
+        data = self.pending + data
+        self.pending = b""
+
+        escape_index = data.rfind(b"\x1b", max(0, len(data) - MAX_ANSI_ESCAPE_PREFIX_LENGTH))
+        if escape_index >= 0 and ANSI_ESCAPE_PREFIX_PATTERN.fullmatch(data, escape_index):
+            self.pending = data[escape_index:]
+            data = data[:escape_index]
+
+        return strip_ansi_escape_codes(data)
+
+    def flush(self):
+        data = self.pending
+        self.pending = b""
+        return data
 
 
 def build_bash_cmd(cmd):
@@ -320,12 +2048,89 @@ def build_bash_cmd(cmd):
     return ['bash', '-O', 'expand_aliases', '-c', f"{LOAD_BASHRC_CMD}\n{cmd}"]
 
 
+def bash_start_warm(run, command, stdin=None, stdout=None, stderr=None):
+    """Starts a command in a fork of the resident bash server, see BASH_SERVER_LOOP.
+
+    Returns a process handle that can be used like a subprocess.Popen."""
+    fd_dir = f"/proc/{os.getpid()}/fd"
+    if not os.path.isdir(fd_dir):
+        # The server opens our file descriptors through /proc, so there's no way around a new shell:
+        return start_process(run, build_bash_cmd(command["content"]), stdin=stdin, stdout=stdout, stderr=stderr)
+
+    proc = WarmProcess()
+    fd_paths = [bash_server_fd_path(proc, fd_dir, stream, std_fd) for std_fd, stream in enumerate([stdin, stdout, stderr])]
+    read_fd, write_fd = os.pipe()
+    proc.responses = os.fdopen(read_fd, 'rb', buffering=0)
+    proc.own_fd(write_fd)
+
+    content = command["content"].encode("utf8")
+    request = f"{fd_dir}/{write_fd} {' '.join(fd_paths)} {len(content)} {run['cwd'] or os.getcwd()}\n".encode("utf8")
+    with BASH_SERVER["lock"]:
+        server = ensure_bash_server()
+        server.stdin.write(request + content)
+        server.stdin.flush()
+
+    # The server opened its own copies of all file descriptors before sending the pid:
+    proc.pid = int(proc.responses.readline() or 0)
+    proc.close_fds()
+    if proc.pid == 0:
+        proc.wait()
+        return start_process(run, build_bash_cmd(command["content"]), stdin=stdin, stdout=stdout, stderr=stderr)
+    return register_process(run, proc)
+
+
+def bash_server_fd_path(proc, fd_dir, stream, std_fd):
+    if stream is None:
+        stream = inherited_stream_for_bash_server(proc, std_fd)
+    fd = proc.to_fd(stream, std_fd)
+    if stat.S_ISFIFO(os.fstat(fd).st_mode):
+        # Opening a pipe through /proc blocks while its other end is closed, e.g. when the
+        # writer of stdin already finished. Keep the other end open until the server has its copy:
+        proc.own_fd(os.open(f"{fd_dir}/{fd}", (os.O_WRONLY if std_fd == 0 else os.O_RDONLY) | os.O_NONBLOCK))
+    return f"{fd_dir}/{fd}"
+
+
+def inherited_stream_for_bash_server(proc, std_fd):
+    mode = os.fstat(std_fd).st_mode
+    if std_fd == 0:
+        # Sockets can't be opened through /proc:
+        return subprocess.DEVNULL if stat.S_ISSOCK(mode) else None
+    if stat.S_ISREG(mode) or stat.S_ISSOCK(mode):
+        # A file opened through /proc gets its own offset and would overwrite our output, so copy through a pipe:
+        return proc.pump_to(std_fd)
+    return None
+
+
+def ensure_bash_server():
+    bashrc_mtime = os.path.getmtime(BASHRC_FILE_NAME) if file_exists(BASHRC_FILE_NAME) else None
+
+    # Restart when peepo.bashrc changed, so commands see the new aliases and functions:
+    if BASH_SERVER["proc"] is not None and (BASH_SERVER["bashrc_mtime"] != bashrc_mtime
+                                            or BASH_SERVER["proc"].poll() is not None):
+        stop_bash_server()
+
+    if BASH_SERVER["proc"] is None:
+        BASH_SERVER["proc"] = subprocess.Popen(build_bash_cmd(BASH_SERVER_LOOP), stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+        BASH_SERVER["bashrc_mtime"] = bashrc_mtime
+
+    return BASH_SERVER["proc"]
+
+
+def stop_bash_server():
+    if BASH_SERVER["proc"] is not None:
+        # Commands that are still running finish on their own and report to their response pipes:
+        BASH_SERVER["proc"].stdin.close()
+        BASH_SERVER["proc"].wait()
+        BASH_SERVER["proc"] = None
+
+
 def convert_peepo_script(args):
     prepare_helper_files()
 
     command_file = os.path.abspath(args["<command_file>"])
 
-    commands = parse_command_file(command_file)
+    branches = parse_command_file(command_file)
+    commands = branches[args["--branch"] if args["--branch"] in branches else default_branch(branches)]["commands"]
 
     script = """
 #!/usr/bin/env bash
@@ -358,12 +2163,420 @@ def get_col_output_file(command):
     return os.path.join(SPOOL_DIR, f"{command['hash']}.col")
 
 
+def get_object_file(command):
+    return os.path.join(SPOOL_DIR, f"{command['hash']}.obj")
+
+
+def open_manifest():
+    """Opens the spool manifest, an index of all cached outputs with their size and last use.
+
+    Cache lookups, touches and housekeeping only go through the manifest, so they don't need to
+    list or stat the spool directory. Existing spool files are imported when the manifest is created."""
+    global MANIFEST_DB  # pylint: disable=global-statement
+    manifest_path = os.path.join(SPOOL_DIR, MANIFEST_FILE_NAME)
+    is_new = not file_exists(manifest_path)
+
+    MANIFEST_DB = sqlite3.connect(manifest_path, timeout=30, isolation_level=None, check_same_thread=False)
+    MANIFEST_DB.execute("PRAGMA journal_mode=WAL")
+    MANIFEST_DB.execute("""CREATE TABLE IF NOT EXISTS entries (
+        name TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        last_used REAL NOT NULL,
+        runtime REAL,
+        exit_status INTEGER,
+        created REAL,
+        output_hash TEXT,
+        input_key TEXT
+    )""")
+    MANIFEST_DB.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+    # Manifests of older versions lack the newer columns. Other instances starting at the same time wait, so only
+    # one adds them:
+    MANIFEST_DB.execute("BEGIN IMMEDIATE")
+    columns = [row[1] for row in query_manifest("PRAGMA table_info(entries)")]
+    for column in ["created REAL", "output_hash TEXT", "input_key TEXT"]:
+        if column.split()[0] not in columns:
+            MANIFEST_DB.execute(f"ALTER TABLE entries ADD COLUMN {column}")
+    MANIFEST_DB.execute("COMMIT")
+    MANIFEST_DB.execute("CREATE INDEX IF NOT EXISTS entries_input_key ON entries (input_key)")
+
+    if is_new:
+        for path in Path(SPOOL_DIR).iterdir():
+            if re.search(r"\.(out|col)(\.gz)?$|\.obj$", path.name):
+                file_stat = path.stat()
+                query_manifest("INSERT OR REPLACE INTO entries (name, size, last_used, created) VALUES (?, ?, ?, ?)",
+                               (path.name, file_stat.st_size, file_stat.st_mtime, file_stat.st_mtime))
+
+
+def query_manifest(sql, params=()):
+    with MANIFEST_LOCK:
+        return MANIFEST_DB.execute(sql, params).fetchall()
+
+
+def find_spool_file(file_path):
+    """Returns the path of the plain or compressed spool file, or None if neither exists."""
+    name = os.path.basename(file_path)
+    rows = query_manifest("SELECT name FROM entries WHERE name IN (?, ?)", (name, name + GZIP_SUFFIX))
+    if not rows:
+        return None
+    if not file_exists(os.path.join(SPOOL_DIR, rows[0][0])):
+        # Removed behind peepo's back, e.g. by hand, so it's a cache miss:
+        remove_spool_entry(rows[0][0])
+        return None
+    return os.path.join(SPOOL_DIR, rows[0][0])
+
+
+def touch_spool_file(file_path):
+    query_manifest("UPDATE entries SET last_used = ? WHERE name = ?", (time.time(), os.path.basename(file_path)))
+
+
+def record_spool_file(file_path, runtime, exit_status, output_hash=None, created=None):
+    # The output counts as created when the command started, so it's older than the outputs of commands
+    # started after it, even if they finished earlier:
+    now = time.time()
+    created = now - runtime if created is None else created
+    query_manifest(
+        "INSERT OR REPLACE INTO entries (name, size, last_used, runtime, exit_status, created, output_hash) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (os.path.basename(file_path), os.path.getsize(file_path), now, runtime, exit_status, created, output_hash))
+
+
+def get_output_created(command):
+    """Returns when the command's cached output was first written, or None if unknown."""
+    return query_manifest("SELECT MIN(created) FROM entries WHERE name IN (?, ?, ?, ?, ?)", get_output_names(command))[0][0]
+
+
+def get_output_names(command):
+    """Returns the names of all spool files that can hold outputs of the command."""
+    names = [os.path.basename(get_output_file(command)), os.path.basename(get_col_output_file(command))]
+    return names + [name + GZIP_SUFFIX for name in names] + [os.path.basename(get_object_file(command))]
+
+
+def open_spool_writer(file_path, compress=None):
+    """Opens a temporary file to write the spool file to, which commit_spool_file moves into place.
+
+    So other peepo instances never read a partly written output, and a killed command leaves its old output intact.
+    The file is compressed if compress is True, or by default with --compress."""
+    compress = COMPRESS if compress is None else compress
+    spool_path = file_path + GZIP_SUFFIX if compress else file_path
+    temp_fd, temp_path = tempfile.mkstemp(dir=SPOOL_DIR,
+                                          prefix=temp_file_prefix(os.path.basename(spool_path)),
+                                          suffix=TEMP_SUFFIX)
+    os.close(temp_fd)
+    if compress:
+        return SpoolWriter(gzip.open(temp_path, 'wb', compresslevel=GZIP_COMPRESS_LEVEL), temp_path, spool_path)
+    return SpoolWriter(open(temp_path, 'wb'), temp_path, spool_path)
+
+
+class SpoolWriter:
+    """A temporary file written to the spool, see open_spool_writer.
+
+    With --cutoff, it hashes the uncompressed output as it is written, so the hash of an output is known without
+    reading it again, see get_input_key."""
+    def __init__(self, file, temp_path, spool_path):
+        self.file = file
+        self.name = temp_path
+        self.spool_path = spool_path
+        self.hasher = hashlib.sha256() if CUTOFF else None
+        # Told about every write if the command has an output limit, see CommandLimiter:
+        self.limiter = None
+        # Opened right before the command starts, see record_spool_file:
+        self.created = time.time()
+
+    def write(self, data):
+        if self.hasher is not None:
+            self.hasher.update(data)
+        if self.limiter is not None:
+            self.limiter.add_output(len(data))
+        return self.file.write(data)
+
+    def tell(self):
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def commit_spool_file(file, runtime, exit_status):
+    """Closes a file opened with open_spool_writer, renames it to its spool file and records it in the manifest."""
+    file.close()
+    os.replace(file.name, file.spool_path)
+    # Don't leave a stale copy with the other compression setting behind:
+    name = os.path.basename(file.spool_path)
+    remove_spool_entry(name[:-len(GZIP_SUFFIX)] if name.endswith(GZIP_SUFFIX) else name + GZIP_SUFFIX)
+    record_spool_file(file.spool_path, runtime, exit_status, file.hasher and file.hasher.hexdigest(), file.created)
+
+
+def discard_spool_file(file):
+    file.close()
+    try:
+        os.remove(file.name)
+    except FileNotFoundError:
+        pass
+
+
+def open_spool_reader(file_path, mode='rb'):
+    if file_path.endswith(GZIP_SUFFIX):
+        return gzip.open(file_path, mode)
+    return open(file_path, mode)
+
+
+def open_spool_stdin(file_path):
+    """Opens a spool file to be passed as stdin to a command.
+
+    Compressed files are decompressed on the fly into a pipe, so they never hit the disk uncompressed."""
+    if not file_path.endswith(GZIP_SUFFIX):
+        return open(file_path, 'rb')
+
+    stdin, sink = os.pipe()
+    threading.Thread(target=pump_to_fd, args=(gzip.open(file_path, 'rb'), sink), daemon=True).start()
+    return os.fdopen(stdin, 'rb')
+
+
+def remove_spool_file(file_path):
+    name = os.path.basename(file_path)
+    for candidate in [name, name + GZIP_SUFFIX]:
+        remove_spool_entry(candidate)
+
+
+def remove_spool_entry(name):
+    query_manifest("DELETE FROM entries WHERE name = ?", (name, ))
+    try:
+        os.remove(os.path.join(SPOOL_DIR, name))
+    except FileNotFoundError:
+        pass
+
+
+class SpoolLock:
+    """A lock on the spool entries of a command hash, shared by all peepo instances and threads using the spool.
+
+    A command runs with the exclusive lock on its hash held, so instances that need the same outputs wait for
+    each other instead of running it twice. Readers hold the shared lock, if they can get it, from looking up
+    an output until it is open, and housekeeping only removes outputs whose exclusive lock it gets right away.
+    Waiting for the lock ends with RunCancelled once run is cancelled. If not blocking, held tells whether
+    the lock was free. The lock file is removed by the last holder."""
+    def __init__(self, name, exclusive=True, run=None, blocking=True):
+        self.path = os.path.join(SPOOL_DIR, name + SPOOL_LOCK_SUFFIX)
+        self.operation = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+        self.run = run
+        self.blocking = blocking
+        self.fd = None
+        self.waited = False
+
+    @property
+    def held(self):
+        return self.fd is not None
+
+    def acquire(self):
+        while True:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT)
+            try:
+                locked = self.lock_fd(fd)
+            except RunCancelled:
+                os.close(fd)
+                raise
+            # The last holder may have removed the lock file before we got the lock, then it doesn't count:
+            if locked and is_same_file(fd, self.path):
+                self.fd = fd
+                return
+            os.close(fd)
+            if not locked:
+                return
+
+    def lock_fd(self, fd):
+        while True:
+            try:
+                fcntl.flock(fd, self.operation | fcntl.LOCK_NB)
+                return True
+            except BlockingIOError:
+                if not self.blocking:
+                    return False
+            if self.run is not None and self.run["cancelled"]:
+                raise RunCancelled()
+            self.waited = True
+            time.sleep(SPOOL_LOCK_POLL_SECONDS)
+
+    def release(self):
+        if self.fd is None:
+            return
+        try:
+            # Only the last holder gets the exclusive lock:
+            fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            if is_same_file(self.fd, self.path):
+                os.remove(self.path)
+        except BlockingIOError:
+            pass
+        os.close(self.fd)
+        self.fd = None
+
+    def __enter__(self):
+        # A lock acquired beforehand is released on exit too:
+        if not self.held:
+            self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+def is_same_file(fd, file_path):
+    try:
+        return os.path.samestat(os.fstat(fd), os.stat(file_path))
+    except FileNotFoundError:
+        return False
+
+
+def show_output_file(file_path):
+    if VIEWPORT is not None:
+        show_viewport_file(file_path)
+        return
+
+    with open_spool_reader(file_path) as file:
+        print(to_terminal_newlines(file.read()).decode("utf8"))
+
+
+def show_ran_output_file(file_path):
+    if VIEWPORT is not None:
+        show_output_file(file_path)
+    else:
+        # The output was already echoed while running, just add the same trailing newline as for cached output.
+        print()
+
+
+def show_viewport_file(file_path):
+    """Shows the file in the viewport from its start, or no file if file_path is None.
+
+    The file stays open while it is shown, so paging through it keeps working even if it is removed from the spool,
+    e.g. by another peepo instance. tidy_spool leaves it alone anyway."""
+    with VIEWPORT["lock"]:
+        if VIEWPORT["reader"] is not None:
+            VIEWPORT["reader"].close()
+        reader = None if file_path is None else open_spool_reader(file_path)
+        VIEWPORT.update(file=file_path, reader=reader, top=0)
+        if reader is not None:
+            render_viewport()
+
+
+def render_viewport():
+    """Shows the screen of the viewport's file starting at its top offset.
+
+    Only the lines on screen are read, so rendering takes constant time and memory regardless of the file size."""
+    lines = []
+    with VIEWPORT["lock"]:
+        file = VIEWPORT["reader"]
+        file.seek(VIEWPORT["top"])
+        for _ in range(viewport_height()):
+            line = read_viewport_line(file)
+            if not line:
+                break
+            lines.append(line.rstrip(b"\r\n").decode("utf8", errors="replace") + "\033[0m\r\n")
+
+        clear_terminal()
+        print("".join(lines), end='')
+        print(VIEWPORT["status"], end='', flush=True)
+
+
+def viewport_height():
+    # Leave room for the empty line and the status lines below the output.
+    return max(1, ROWS - 1 - max(1, VIEWPORT["status"].count("\n")))
+
+
+def read_viewport_line(file):
+    """Reads one line, truncating very long lines so memory stays bounded."""
+    line = file.readline(VIEWPORT_MAX_LINE_BYTES)
+    if line and not line.endswith(b"\n"):
+        rest = line
+        while rest and not rest.endswith(b"\n"):
+            rest = file.readline(VIEWPORT_CHUNK_SIZE)
+    return line
+
+
+def scroll_viewport(pages):
+    if VIEWPORT is None:
+        return
+
+    with VIEWPORT["lock"]:
+        file = VIEWPORT["reader"]
+        if file is None:
+            return
+        if pages > 0:
+            VIEWPORT["top"] = seek_lines_forward(file, VIEWPORT["top"], pages * viewport_height())
+        else:
+            VIEWPORT["top"] = seek_lines_back(file, VIEWPORT["top"], -pages * viewport_height())
+        render_viewport()
+
+
+def scroll_viewport_to_end(at_bottom):
+    if VIEWPORT is None:
+        return
+
+    with VIEWPORT["lock"]:
+        file = VIEWPORT["reader"]
+        if file is None:
+            return
+        VIEWPORT["top"] = seek_lines_back(file, seek_end(file), viewport_height()) if at_bottom else 0
+        render_viewport()
+
+
+def seek_lines_forward(file, offset, count):
+    """Returns the offset of the line that is count lines after the line starting at offset, stopping at the last line."""
+    file.seek(offset)
+    for _ in range(count):
+        if not read_viewport_line(file) or not file.peek(1):
+            break
+        offset = file.tell()
+    return offset
+
+
+def seek_end(file):
+    try:
+        return file.seek(0, os.SEEK_END)
+    except ValueError:
+        # Gzip files can't seek from the end, so decompress through to it:
+        while file.read(VIEWPORT_CHUNK_SIZE):
+            pass
+        return file.tell()
+
+
+def seek_lines_back(file, offset, count):
+    """Returns the offset of the line that is count lines before the line starting at offset.
+
+    Reads the file backwards in chunks, so only the skipped lines are read."""
+    # Skip the newline that ends the line before offset:
+    pos = offset - 1
+    while pos > 0:
+        chunk_start = max(0, pos - VIEWPORT_CHUNK_SIZE)
+        file.seek(chunk_start)
+        chunk = file.read(pos - chunk_start)
+        newline_index = len(chunk)
+        while True:
+            newline_index = chunk.rfind(b"\n", 0, newline_index)
+            if newline_index < 0:
+                break
+            count -= 1
+            if count == 0:
+                return chunk_start + newline_index + 1
+        pos = chunk_start
+    return 0
+
+
+def to_terminal_newlines(data):
+    # The terminal is in raw mode while listening for keys, so it needs \r to return to the start of the line.
+    # Colored outputs captured by older peepo versions already contain \r\n.
+    return data.replace(b"\r\n", b"\n").replace(b"\n", b"\r\n")
+
+
 def clear_terminal():
     print(chr(27) + "[2J\r")
 
 
-def strip_ansi_escape_codes(string):
-    return ANSI_ESCAPE_PATTERN.sub('', string)
+def strip_ansi_escape_codes(data):
+    return ANSI_ESCAPE_PATTERN.sub(b'', data)
 
 
 def sha1(content):
@@ -380,17 +2593,60 @@ def file_exists(file_name):
     return Path(file_name).is_file()
 
 
-def watch_file(command_file, on_modified):
-    def internal_on_modified(modified_file):
-        if modified_file == command_file:
+def watch_file(command_file, on_modified, observer=None):
+    """Calls on_modified when the content of the command file changes and returns a function to stop watching.
+
+    Editors often save a file in several writes, or write a new file and rename it to the file. So on_modified is
+    only called once there were no events for the file for DEBOUNCE_SECONDS, and only if the content changed.
+    The file is watched with observer if given, which can watch other files too, or with a new one."""
+    watch = {"hash": hash_file(command_file), "timer": None, "lock": threading.Lock()}
+
+    def on_settled():
+        with watch["lock"]:
+            content_hash = hash_file(command_file)
+            # A missing file is about to be replaced:
+            if content_hash is None or content_hash == watch["hash"]:
+                return
+            watch["hash"] = content_hash
             on_modified()
 
-    event_handler = Handler(internal_on_modified)
-    observer = Observer()
+    def internal_on_modified(modified_file):
+        if modified_file != command_file:
+            return
+        with watch["lock"]:
+            if watch["timer"] is not None:
+                watch["timer"].cancel()
+            watch["timer"] = threading.Timer(DEBOUNCE_SECONDS, on_settled)
+            watch["timer"].daemon = True
+            watch["timer"].start()
 
-    observer.schedule(event_handler, Path(command_file).parent.absolute(), recursive=False)
-    observer.start()
-    return observer.stop
+    event_handler = Handler(internal_on_modified)
+    own_observer = observer is None
+    if own_observer:
+        observer = Observer()
+    event_watch = observer.schedule(event_handler, Path(command_file).parent.absolute(), recursive=False)
+    if own_observer:
+        observer.start()
+
+    def stop():
+        if own_observer:
+            observer.stop()
+        else:
+            observer.remove_handler_for_watch(event_handler, event_watch)
+        with watch["lock"]:
+            if watch["timer"] is not None:
+                watch["timer"].cancel()
+
+    return stop
+
+
+def hash_file(file_path):
+    """Returns the hash of the file's content, or None if it doesn't exist."""
+    try:
+        with open(file_path, 'rb') as file:
+            return hashlib.sha1(file.read()).hexdigest()
+    except FileNotFoundError:
+        return None
 
 
 class Handler(FileSystemEventHandler):
@@ -401,14 +2657,275 @@ class Handler(FileSystemEventHandler):
         if event.is_directory:
             return
 
-        if event.event_type == 'modified':
+        if event.event_type in ['modified', 'created']:
             self.on_mod(event.src_path)
+        elif event.event_type == 'moved':
+            # Editors that save atomically write a temporary file and rename it to the file:
+            self.on_mod(event.dest_path)
 
 
 def py_build_command(spool_file):
     return f"python {spool_file}"
 
 
+def py_start_warm(run, command, stdin=None, stdout=None, stderr=None):
+    """Starts a python block in a fork of the resident python server, see serve_python_blocks.
+
+    Returns a process handle that can be used like a subprocess.Popen."""
+    with PYTHON_SERVER["lock"]:
+        server = ensure_python_server()
+    proc = WarmProcess()
+    fds = []
+    for stream in [stdin, stdout, stderr]:
+        fds.append(proc.to_fd(stream, len(fds)))
+
+    proc.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    proc.sock.connect(server["socket"])
+    limits = get_limits(command)
+    request = {
+        "script": command["script_file"],
+        "cwd": run["cwd"] or os.getcwd(),
+        "env": command.get("env", {}),
+        "limits": {
+            "cpu": limits["cpu"],
+            "memory": limits["memory"]
+        }
+    }
+    request = json.dumps(request).encode("utf8")
+    proc.sock.sendmsg([request], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", fds))])
+    proc.close_fds()
+
+    # Unbuffered, so poll sees the exit code even if it arrived together with the pid:
+    proc.responses = proc.sock.makefile('rb', buffering=0)
+    proc.pid = int(proc.responses.readline())
+    return register_process(run, proc)
+
+
+class WarmProcess:  # pylint: disable=too-many-instance-attributes
+    """Handle of a command running in a fork of the resident python or bash server.
+
+    The server sends the pid of the fork and, once it exited, its exit code. The python server adds the CPU time
+    and peak memory of the fork."""
+    def __init__(self):
+        self.pid = None
+        self.returncode = None
+        self.usage = None
+        self.stdout = None
+        self.sock = None
+        self.responses = None
+        self.owned_fds = []
+        self.pumps = []
+
+    def to_fd(self, stream, std_fd):
+        if stream is None:
+            return std_fd
+        if stream == subprocess.DEVNULL:
+            return self.own_fd(os.open(os.devnull, os.O_RDWR))
+        if stream == subprocess.PIPE:
+            # Only needed for stdout:
+            read_fd, write_fd = os.pipe()
+            self.stdout = os.fdopen(read_fd, 'rb')
+            return self.own_fd(write_fd)
+        if isinstance(stream, int):
+            return stream
+        return stream.fileno()
+
+    def pump_to(self, sink):
+        read_fd, write_fd = os.pipe()
+        pump = threading.Thread(target=pump_to_fd, args=(os.fdopen(read_fd, 'rb'), os.dup(sink)))
+        pump.start()
+        self.pumps.append(pump)
+        return self.own_fd(write_fd)
+
+    def own_fd(self, fd):
+        self.owned_fds.append(fd)
+        return fd
+
+    def close_fds(self):
+        # The fork has its own copies now:
+        for fd in self.owned_fds:
+            os.close(fd)
+
+    def poll(self):
+        if self.returncode is None and select.select([self.responses], [], [], 0)[0]:
+            self.wait()
+        return self.returncode
+
+    def wait(self):
+        if self.returncode is None:
+            response = self.responses.readline().split()
+            self.returncode = int(response[0]) if response else -signal.SIGKILL
+            if len(response) == 3:
+                self.usage = {"cpu_seconds": float(response[1]), "max_rss_bytes": int(response[2])}
+            self.responses.close()
+            if self.sock is not None:
+                self.sock.close()
+            for pump in self.pumps:
+                pump.join()
+        return self.returncode
+
+
+def ensure_python_server():
+    helper_file = BLOCK_DEFS["py"]["helper_file"]
+    helper_mtime = os.path.getmtime(helper_file) if file_exists(helper_file) else None
+
+    # Restart when the helpers changed, so newly added imports are preloaded too:
+    if PYTHON_SERVER["proc"] is not None and PYTHON_SERVER["helper_mtime"] != helper_mtime:
+        stop_python_server()
+
+    if PYTHON_SERVER["proc"] is None or PYTHON_SERVER["proc"].poll() is not None:
+        socket_dir = tempfile.mkdtemp(prefix="peepo")
+        socket_path = os.path.join(socket_dir, "python.sock")
+        bootstrap = (f"import sys; sys.path.insert(0, {SCRIPT_DIR!r}); import peepo; "
+                     f"peepo.serve_python_blocks({socket_path!r}, {helper_file!r})")
+        proc = subprocess.Popen([sys.executable, "-c", bootstrap], stdin=subprocess.DEVNULL)
+        PYTHON_SERVER.update(proc=proc, socket=socket_path, socket_dir=socket_dir, helper_mtime=helper_mtime)
+        wait_for_socket(socket_path, proc)
+
+    return PYTHON_SERVER
+
+
+def wait_for_socket(socket_path, proc):
+    while not os.path.exists(socket_path):
+        if proc.poll() is not None:
+            raise RuntimeError(f"Python server exited with return code {proc.returncode}")
+        time.sleep(0.005)
+
+
+def stop_python_server():
+    if PYTHON_SERVER["proc"] is not None:
+        PYTHON_SERVER["proc"].kill()
+        PYTHON_SERVER["proc"].wait()
+        shutil.rmtree(PYTHON_SERVER["socket_dir"], ignore_errors=True)
+        PYTHON_SERVER["proc"] = None
+
+
+def serve_python_blocks(socket_path, helper_file):
+    """Main loop of the python server.
+
+    It imports the helpers once, then forks for every python block it receives. The fork inherits
+    all already imported modules, so a block only pays for the imports it doesn't share with helpers.py."""
+    sys.path.remove(SCRIPT_DIR)
+    if file_exists(helper_file):
+        with open(helper_file, 'r') as file:
+            exec(compile(file.read(), helper_file, 'exec'), {"__name__": "peepo_helpers"})  # pylint: disable=exec-used
+
+    # Wake up the select loop when forks exit:
+    wakeup_read, wakeup_write = os.pipe()
+    os.set_blocking(wakeup_write, False)
+    signal.set_wakeup_fd(wakeup_write)
+    signal.signal(signal.SIGCHLD, lambda *_: None)
+
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(socket_path + ".tmp")
+    listener.listen()
+    os.rename(socket_path + ".tmp", socket_path)
+
+    parent_pid = os.getppid()
+    connections = {}
+    while os.getppid() == parent_pid:
+        readable, _, _ = select.select([listener, wakeup_read], [], [], 1)
+        if wakeup_read in readable:
+            os.read(wakeup_read, 4096)
+            reap_python_blocks(connections)
+        if listener in readable:
+            conn, _ = listener.accept()
+            pid = fork_python_block(conn, [listener.fileno(), wakeup_read, wakeup_write])
+            if pid is not None:
+                connections[pid] = conn
+            else:
+                conn.close()
+
+
+def fork_python_block(conn, server_fds):
+    request, fds = receive_fds(conn, 3)
+    if len(fds) != 3:
+        return None
+
+    request = json.loads(request)
+    pid = os.fork()
+    if pid == 0:
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        for fd in server_fds + [conn.fileno()]:
+            os.close(fd)
+        run_python_block(request, fds)
+
+    for fd in fds:
+        os.close(fd)
+    conn.sendall(f"{pid}\n".encode("utf8"))
+    return pid
+
+
+def reap_python_blocks(connections):
+    while connections:
+        pid, status, rusage = os.wait4(-1, os.WNOHANG)
+        if pid == 0:
+            break
+        conn = connections.pop(pid, None)
+        if conn is not None:
+            usage = usage_of(rusage)
+            try:
+                conn.sendall(f"{exit_code_of_status(status)} {usage['cpu_seconds']} {usage['max_rss_bytes']}\n".encode("utf8"))
+            except OSError:
+                pass
+            conn.close()
+
+
+def receive_fds(conn, max_fds):
+    fds = array.array("i")
+    msg, ancdata, _, _ = conn.recvmsg(4096, socket.CMSG_SPACE(max_fds * fds.itemsize))
+    for level, kind, data in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(data[:len(data) - (len(data) % fds.itemsize)])
+    return msg, list(fds)
+
+
+def run_python_block(request, fds):
+    # Own process group, so the block and its children can be killed like any other command:
+    os.setsid()
+    for std_fd, fd in enumerate(fds):
+        os.dup2(fd, std_fd)
+    for fd in set(fds):
+        if fd > 2:
+            os.close(fd)
+    sys.stdin = open(0, 'r', closefd=False)
+    sys.stdout = open(1, 'w', closefd=False)
+    sys.stderr = open(2, 'w', closefd=False)
+
+    os.chdir(request["cwd"])
+    os.environ.update(request["env"])
+    if request["limits"]["cpu"] is not None:
+        resource.setrlimit(resource.RLIMIT_CPU, (request["limits"]["cpu"], request["limits"]["cpu"] + 1))
+    if request["limits"]["memory"] is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (request["limits"]["memory"], request["limits"]["memory"]))
+    script = request["script"]
+    sys.argv = [script]
+    sys.path[0] = os.path.dirname(os.path.realpath(script))
+
+    exit_code = 0
+    try:
+        runpy.run_path(script, run_name="__main__")
+    except SystemExit as exc:
+        exit_code = exit_code_of(exc)
+    except BaseException:  # pylint: disable=broad-except
+        traceback.print_exc()
+        exit_code = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+    os._exit(exit_code)  # pylint: disable=protected-access
+
+
+def exit_code_of(system_exit):
+    if system_exit.code is None:
+        return 0
+    if isinstance(system_exit.code, int):
+        return system_exit.code
+    print(system_exit.code, file=sys.stderr)
+    return 1
+
+
 def py_build_script(content):
     indent_script = content.strip().replace("\n", "\n\t").replace("$", "\\$")
     return f"python <(cat <<-EOF\n\t{indent_script}\nEOF\n)"
@@ -448,7 +2965,8 @@ BLOCK_DEFS = {
     "py": {
         "build_command": py_build_command,
         "helper_file": f"{SCRIPT_DIR}/helpers.py",
-        "build_script": py_build_script
+        "build_script": py_build_script,
+        "start_warm": py_start_warm
     },
     "sh": {
         "build_command": sh_build_command,
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""peepo benchmarks.
+
+Runs peepo with --once on generated command files and inputs, and compares the wall time and peak memory
+of each scenario against stored baselines.
+
+Usage:
+  benchmark.py [--size=<size>] [--tolerance=<ratio>] [--baseline=<file>] [--save] [--only=<scenario>]
+  benchmark.py (-h | --help)
+
+Options:
+  -h --help            Show this screen.
+  --size=<size>        Size of the generated input of the large output scenarios in megabytes. [default: 256]
+  --tolerance=<ratio>  How much worse than the baseline a measurement may be before it counts as a regression,
+                       e.g. 0.5 for 50%. [default: 0.5]
+  --baseline=<file>    Baseline file (default: benchmark_baseline.json next to this script)
+  --save               Write the measurements to the baseline file instead of comparing against it.
+  --only=<scenario>    Only run the scenario with this name.
+
+"""
+import itertools
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from docopt import docopt
+
+TEST_DIR = os.path.dirname(os.path.realpath(__file__))
+TOP_DIR = os.path.join(TEST_DIR, "..")
+BASELINE_FILE = os.path.join(TEST_DIR, "benchmark_baseline.json")
+# Measurements of all runs except the first are kept, and the fastest counts, to smooth out noise:
+REPEATS = 3
+LINE = b"0123456789 the quick brown fox jumps over the lazy dog 0123456789\n"
+
+
+def main(args):
+    baseline_file = args["--baseline"] or BASELINE_FILE
+    size = int(args["--size"]) * 1024**2
+    work_dir = tempfile.mkdtemp(prefix="peepo-bench-")
+    try:
+        results = {}
+        for name, scenario in SCENARIOS.items():
+            if args["--only"] in [None, name]:
+                results[name] = scenario(work_dir, size)
+                print(f"{name}: {format_result(results[name])}", flush=True)
+                shutil.rmtree(os.path.join(work_dir, "spool"), ignore_errors=True)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args["--save"]:
+        save_baseline(baseline_file, results)
+        return 0
+    return 1 if report_regressions(load_baseline(baseline_file), results, float(args["--tolerance"])) else 0
+
+
+def bench_startup(work_dir, _size):
+    """Time to start, run a single trivial command and exit."""
+    command_file = write_command_file(work_dir, ["echo a"])
+    return measure(lambda: run_peepo(work_dir, command_file, "--force"))
+
+
+def bench_cache_hits(work_dir, _size):
+    """Overhead of a long pipeline where every command uses its cached output."""
+    stages = 100
+    command_file = write_command_file(work_dir, ["seq 1 1000"] + [f"cat # {k}" for k in range(stages - 1)])
+    run_peepo(work_dir, command_file)
+    result = measure(lambda: run_peepo(work_dir, command_file))
+    result["seconds_per_stage"] = result["seconds"] / stages
+    return result
+
+
+def bench_edit_last_line(work_dir, _size):
+    """Latency from changing the last line of a long command file to its output, with everything else cached."""
+    lines = ["seq 1 1000"] + [f"cat # {k}" for k in range(198)]
+    command_file = write_command_file(work_dir, lines + ["wc -l"])
+    run_peepo(work_dir, command_file)
+
+    edits = itertools.count()
+
+    def edit_and_run():
+        write_command_file(work_dir, lines + [f"wc -l # {next(edits)}"])
+        return run_peepo(work_dir, command_file)
+
+    return measure(edit_and_run)
+
+
+def bench_python_blocks(work_dir, _size):
+    """Preparing and running many python blocks, which are prefixed with the helpers."""
+    lines = ["seq 1 10"]
+    for k in range(20):
+        lines += ["(py", "    import sys", f"    sys.stdout.write(sys.stdin.read())  # {k}", "py)"]
+    command_file = write_command_file(work_dir, lines)
+    return measure(lambda: run_peepo(work_dir, command_file, "--force"))
+
+
+def bench_large_output(work_dir, size):
+    """Throughput of commands passing a large input along, through the spool."""
+    return bench_large(work_dir, size, "")
+
+
+def bench_large_output_stream(work_dir, size):
+    """Throughput of commands passing a large input along as one pipeline."""
+    return bench_large(work_dir, size, "--stream")
+
+
+def bench_large_output_compressed(work_dir, size):
+    """Throughput of commands passing a large input along, through a compressed spool."""
+    return bench_large(work_dir, size, "--compress")
+
+
+def bench_large(work_dir, size, extra_args):
+    input_file = generate_input(work_dir, size)
+    stages = 3
+    command_file = write_command_file(work_dir, [f"cat {input_file}", "cat", "cat", "wc -l"])
+    result = measure(lambda: run_peepo(work_dir, command_file, f"--force {extra_args}"))
+    result["mb_per_second"] = size * stages / 1024**2 / result["seconds"]
+    return result
+
+
+def bench_tidy_spool(work_dir, _size):
+    """Importing a spool with thousands of outputs into a new manifest and removing most of them."""
+    command_file = write_command_file(work_dir, ["echo a"])
+    spool_dir = os.path.join(work_dir, "spool")
+
+    def fill_spool_and_run():
+        shutil.rmtree(spool_dir, ignore_errors=True)
+        os.makedirs(spool_dir)
+        for k in range(5000):
+            with open(os.path.join(spool_dir, f"{k:040x}.out"), 'wb') as file:
+                file.write(LINE * 16)
+        return run_peepo(work_dir, command_file, "--spool-size=1M")
+
+    return measure(fill_spool_and_run)
+
+
+SCENARIOS = {
+    "startup": bench_startup,
+    "cache_hits": bench_cache_hits,
+    "edit_last_line": bench_edit_last_line,
+    "python_blocks": bench_python_blocks,
+    "large_output": bench_large_output,
+    "large_output_stream": bench_large_output_stream,
+    "large_output_compressed": bench_large_output_compressed,
+    "tidy_spool": bench_tidy_spool,
+}
+
+
+def measure(run):
+    """Calls run, which returns the seconds and peak memory of a peepo run, several times and keeps the best."""
+    measurements = [run() for _ in range(REPEATS + 1)][1:]
+    return {
+        "seconds": min(seconds for seconds, _ in measurements),
+        "peak_rss_mb": min(peak_rss for _, peak_rss in measurements),
+    }
+
+
+def run_peepo(work_dir, command_file, extra_args=""):
+    """Runs peepo once and returns its wall time in seconds and its peak memory in megabytes.
+
+    The peak memory is only peepo's own, not that of the commands it runs."""
+    args = [f"{TOP_DIR}/peepo.py", command_file, f"--spool={work_dir}/spool", "--once", "--cols=80"] + extra_args.split()
+    start = time.perf_counter()
+    proc = subprocess.Popen(args, cwd=TOP_DIR, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+    _, status, usage = os.wait4(proc.pid, 0)
+    seconds = time.perf_counter() - start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode != 0:
+        raise RuntimeError(f"peepo failed with return code {proc.returncode}: {' '.join(args)}")
+    # ru_maxrss is in kilobytes on Linux:
+    return seconds, usage.ru_maxrss / 1024
+
+
+def write_command_file(work_dir, lines):
+    command_file = os.path.join(work_dir, "bench.input.sh")
+    with open(command_file, 'w') as file:
+        file.write("\n".join(lines) + "\n")
+    return command_file
+
+
+def generate_input(work_dir, size):
+    input_file = os.path.join(work_dir, f"input-{size}.txt")
+    if not os.path.exists(input_file):
+        chunk = LINE * (1024**2 // len(LINE))
+        with open(input_file, 'wb') as file:
+            for _ in range(size // len(chunk)):
+                file.write(chunk)
+    return input_file
+
+
+def format_result(result):
+    return ", ".join(f"{key}={value:.4g}" for key, value in result.items())
+
+
+def load_baseline(baseline_file):
+    if not os.path.exists(baseline_file):
+        return {}
+    with open(baseline_file, 'r') as file:
+        return json.load(file)
+
+
+def save_baseline(baseline_file, results):
+    with open(baseline_file, 'w') as file:
+        json.dump(results, file, indent=2, sort_keys=True)
+        file.write("\n")
+    print(f"Saved baseline to {baseline_file}")
+
+
+def report_regressions(baseline, results, tolerance):
+    """Prints the measurements that are worse than the baseline by more than the tolerance and returns them."""
+    regressions = []
+    for name, result in results.items():
+        for key, value in result.items():
+            expected = baseline.get(name, {}).get(key)
+            if expected is None:
+                continue
+            # Throughput regresses when it goes down, everything else when it goes up:
+            ratio = expected / value if key.endswith("_per_second") else value / expected
+            if ratio > 1 + tolerance:
+                regressions.append(f"{name} {key}: {value:.4g} (baseline {expected:.4g})")
+
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if not baseline:
+        print("No baseline to compare against, save one with --save")
+    return regressions
+
+
+if __name__ == '__main__':
+    sys.exit(main(docopt(__doc__)))
@@ -1,7 +1,13 @@
+import contextlib
 import subprocess
 import os
+import json
 import re
 import shutil
+import sqlite3
+import pty
+import select
+import time
 
 TEST_DIR = os.path.dirname(os.path.realpath(__file__))
 SPOOL_DIR = os.path.join(TEST_DIR, "spool")
@@ -100,6 +106,31 @@ def test_run_error():
         f"{TEST_DIR}/testdata/test_error.output.txt") + "\nFAILED (ran 1/3) cmd 1/3: cat nonexistentfile"
 
 
+def test_limits():
+    command_file = f"{SPOOL_DIR}/limits.input.sh"
+    # Command file content, extra args and the status line:
+    cases = [("yes\nhead -1\n", "--limit=output=1M", "FAILED (ran 1/2) cmd 1/2 (output limit): yes"),
+             ("#@limit time=1s\nsleep 10\ncat\n", "", "FAILED (ran 1/2) cmd 1/2 (time limit): sleep 10"),
+             ("#@limit time=none\nsleep 2; echo a\ncat\n", "--limit=time=1s", "OK (ran 2/2) cmd 2/2: cat"),
+             ("#@limit cpu=1s\nwhile :; do :; done\n", "--stream", "FAILED (ran 1/1) cmd 1/1 (cpu limit): while :; do :; ...")]
+    for content, extra_args, status in cases:
+        print(f"Testcase {content!r}")
+        delete_spool()
+        os.makedirs(SPOOL_DIR, exist_ok=True)
+        write_file(command_file, content)
+        started = time.monotonic()
+        returncode, stdout, stderr = run_peepo(command_file, extra_args=extra_args)
+        assert returncode == 0
+        assert stdout.endswith(status)
+        assert time.monotonic() - started < 5
+
+        # The output of a stopped command is discarded:
+        if status.startswith("FAILED"):
+            assert "exceeded its" in stdout
+            assert count_spool_files(".out") == 0
+            assert count_spool_files(".tmp") == 0
+
+
 def test_uses_python_venv():
     delete_spool()
     # Should use peepo script's venv when running python blocks
@@ -143,6 +174,574 @@ def from_json():
     assert stdout == "$oi: changed!\n\n\nOK (ran 1/3) cmd 3/3: data = from_json() print(\"$oi: ..."
 
 
+def test_streaming_helpers():
+    delete_spool()
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    command_file = f"{SPOOL_DIR}/helpers.input"
+
+    # JSON arrays and NDJSON are both iterated value by value, also NDJSON whose rows are arrays:
+    for jq_filter in [".data", ".data[]", ".data[] | [.]"]:
+        write_file(command_file, f"jq -c '{jq_filter}' tests/testdata/users.json\n(py\n"
+                   "    print(sum((user[0] if isinstance(user, list) else user)['id'] for user in iter_json()))\npy)\n")
+        returncode, stdout, stderr = run_peepo(command_file)
+        assert stderr == ""
+        assert stdout.startswith("57\n")
+
+    write_file(command_file, "printf 'a;\"b;c\"\\n'\n(py\n    print(list(from_csv()))\npy)\n")
+    returncode, stdout, stderr = run_peepo(command_file)
+    assert stdout.startswith("[['a', 'b;c']]\n")
+
+
+def test_object_handoff():
+    delete_spool()
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    command_file = f"{SPOOL_DIR}/objects.input"
+    to_object_block = "(py\n    to_object([int(line) for line in from_lines()])\npy)\n"
+    write_file(command_file, f"seq 1 5\n{to_object_block}(py\n    print(type(from_object()).__name__)\npy)\n")
+    for extra_args in ["", "--warm --force"]:
+        returncode, stdout, stderr = run_peepo(command_file, extra_args=extra_args)
+        assert stderr == ""
+        assert stdout.startswith("list\n")
+
+    # The first block handed its object to the second block without printing it:
+    assert count_spool_files(".obj") == 1
+    assert count_spool_files(".out") == 2
+
+    # A shell command needs the text, so the block runs again to print it:
+    write_file(command_file, f"seq 1 5\n{to_object_block}jq length\n")
+    returncode, stdout, stderr = run_peepo(command_file)
+    assert stdout == "5\n\n\nOK (ran 2/3) cmd 3/3: jq length"
+
+
+def test_run_streaming():
+    for case in CASES:
+        delete_spool()
+        print(f"Testcase {case['input']}")
+
+        returncode, stdout, stderr = run_peepo(case["input"], extra_args="--stream")
+        assert returncode == 0
+        assert stderr == ""
+        assert stdout == load_file(case["output"]) + case["status"]
+
+
+def test_run_streaming_uses_cache():
+    delete_spool()
+    run_peepo(f"{TEST_DIR}/testdata/test1.input.sh", extra_args="--stream")
+
+    returncode, stdout, stderr = run_peepo(f"{TEST_DIR}/testdata/test2.input.sh", extra_args="--stream")
+    assert returncode == 0
+    assert stderr == ""
+    assert stdout == load_file(f"{TEST_DIR}/testdata/test2.output.txt") + "\n\nOK (ran 1/5) cmd 5/5: wc -c"
+
+    # Intermediate outputs were spooled while streaming, so the non-streaming mode can reuse them:
+    returncode, stdout, stderr = run_peepo(f"{TEST_DIR}/testdata/test2.input.sh")
+    assert stdout == load_file(f"{TEST_DIR}/testdata/test2.output.txt") + "\n\nOK (ran 0/5) cmd 5/5: wc -c"
+
+
+def test_run_streaming_error():
+    delete_spool()
+    returncode, stdout, stderr = run_peepo(f"{TEST_DIR}/testdata/test_error.input.sh", extra_args="--stream")
+    assert returncode == 0
+    assert "Command 1 failed with return code 1" in stdout
+    assert stdout.endswith("FAILED (ran 3/3) cmd 1/3: cat nonexistentfile")
+    assert not [f for f in os.listdir(SPOOL_DIR) if f.endswith((".out", ".col"))]
+
+
+def test_run_compressed():
+    for case in CASES:
+        delete_spool()
+        print(f"Testcase {case['input']}")
+
+        returncode, stdout, stderr = run_peepo(case["input"], extra_args="--compress")
+        assert returncode == 0
+        assert stderr == ""
+        assert stdout == load_file(case["output"]) + case["status"]
+
+    delete_spool()
+    run_peepo(f"{TEST_DIR}/testdata/test1.input.sh", extra_args="--compress")
+    assert all(f.endswith(".gz") for f in os.listdir(SPOOL_DIR) if ".out" in f or ".col" in f)
+
+    # Compressed outputs are decompressed when used as input:
+    for extra_args in ["--compress", "", "--stream --compress"]:
+        returncode, stdout, stderr = run_peepo(f"{TEST_DIR}/testdata/test2.input.sh", extra_args=extra_args)
+        assert returncode == 0
+        assert stderr == ""
+        assert stdout.startswith(load_file(f"{TEST_DIR}/testdata/test2.output.txt") + "\n\nOK")
+
+
+def test_tidy_spool_by_size():
+    delete_spool()
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    big_file = f"{SPOOL_DIR}/big.out"
+    with open(big_file, 'wb') as file:
+        file.write(b"x" * 20 * 1024)
+    os.utime(big_file, (0, 0))
+
+    returncode, stdout, stderr = run_peepo(f"{TEST_DIR}/testdata/test1.input.sh", extra_args="--spool-size=10K")
+    assert returncode == 0
+    assert not os.path.exists(big_file)
+
+    # The small, recently used outputs are still cached:
+    returncode, stdout, stderr = run_peepo(f"{TEST_DIR}/testdata/test1.input.sh", extra_args="--spool-size=10K")
+    assert stdout.endswith("OK (ran 0/4) cmd 4/4: tr '\\n' ','")
+
+
+def test_tidy_spool_removes_stale_temp_files():
+    delete_spool()
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    exited = subprocess.Popen(["true"])
+    exited.wait()
+    # Temporary files are named after the pid of the process writing them:
+    dead_file = f"{SPOOL_DIR}/abc.out.{exited.pid}.x1.tmp"
+    live_file = f"{SPOOL_DIR}/abc.out.{os.getpid()}.x2.tmp"
+    old_file = f"{SPOOL_DIR}/abc.out.x3.tmp"
+    for temp_file in [dead_file, live_file, old_file]:
+        write_file(temp_file, "partial output")
+    os.utime(old_file, (0, 0))
+
+    returncode, stdout, stderr = run_peepo(f"{TEST_DIR}/testdata/test1.input.sh")
+    assert returncode == 0
+    assert not os.path.exists(dead_file)
+    assert os.path.exists(live_file)
+    assert not os.path.exists(old_file)
+
+
+def test_tidy_spool_keeps_block_scripts():
+    delete_spool()
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    command_file = f"{SPOOL_DIR}/scripts.input.sh"
+    write_file(command_file, "seq 1 20000\n(py\n    import sys\n    print(len(sys.stdin.read()))\npy)\n")
+    with run_peepo_in_pty(command_file, "--spool-size=10K") as (_, master):
+        # The outputs don't fit into the spool, but the script of the block stays, so rerunning it with r works:
+        assert b"OK (ran 2/2)" in read_pty(master, until=b"(ran 2/2)")
+        assert count_spool_files(".py") == 1
+        os.write(master, b"r")
+        assert b"OK (ran 2/2)" in read_pty(master, until=b"(ran 2/2)")
+
+
+def test_spool_manifest():
+    delete_spool()
+    run_peepo(f"{TEST_DIR}/testdata/test1.input.sh")
+
+    with sqlite3.connect(f"{SPOOL_DIR}/manifest.db") as db:
+        entries = db.execute("SELECT name, size, runtime, exit_status FROM entries").fetchall()
+
+    # The last command's plain output is captured together with the colored one:
+    assert sorted(name.split(".")[1] for name, *_ in entries) == ["col", "out", "out", "out", "out"]
+    for name, size, runtime, exit_status in entries:
+        assert size == os.path.getsize(f"{SPOOL_DIR}/{name}")
+        assert runtime >= 0
+        assert exit_status == 0
+
+
+def test_spool_files_removed_by_hand():
+    delete_spool()
+    run_peepo(f"{TEST_DIR}/testdata/test1.input.sh")
+    for name in os.listdir(SPOOL_DIR):
+        if name.endswith(".out"):
+            os.remove(f"{SPOOL_DIR}/{name}")
+
+    # Outputs missing from the spool are cache misses, even though the manifest still knows them:
+    returncode, stdout, stderr = run_peepo(f"{TEST_DIR}/testdata/test1.input.sh")
+    assert returncode == 0
+    assert stderr == ""
+    assert stdout.endswith("OK (ran 4/4) cmd 4/4: tr '\\n' ','")
+
+
+def test_concurrent_instances_share_outputs():
+    delete_spool()
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    command_file = f"{SPOOL_DIR}/concurrent.input"
+    # Each run leaves a file named after the shell's pid behind:
+    write_file(command_file, f"touch {SPOOL_DIR}/run-$$; sleep 1; echo a\nsed 's/a/b/'\n")
+
+    # Both instances need the same outputs, so one waits for the other instead of running the commands again:
+    args = ["./peepo.py", command_file, f"--spool={SPOOL_DIR}", "--once", "--cols=60"]
+    procs = [subprocess.Popen(args, stdout=subprocess.PIPE) for _ in range(2)]
+    outputs = [proc.communicate(timeout=30)[0].decode("utf8") for proc in procs]
+    assert all(proc.returncode == 0 for proc in procs)
+    assert all("b" in output.splitlines() for output in outputs)
+    assert len([f for f in os.listdir(SPOOL_DIR) if f.startswith("run-")]) == 1
+
+    # Outputs are written to temporary files and renamed, and the locks are removed when released:
+    assert count_spool_files(".tmp") == 0
+    assert count_spool_files(".lock") == 0
+
+
+def test_viewport():
+    delete_spool()
+    for cmds_ran in [1, 0]:
+        returncode, stdout, stderr = run_peepo(f"{TEST_DIR}/testdata/test_viewport.input.sh", extra_args="--viewport --rows=5")
+        assert returncode == 0
+        assert stderr == ""
+        assert stdout == f"1\n2\n3\n\nOK (ran {cmds_ran}/1) cmd 1/1: seq 1 1000"
+
+
+def test_viewport_keys():
+    delete_spool()
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    command_file = f"{SPOOL_DIR}/viewport.input.sh"
+    write_file(command_file, "seq 1 200000\ncat\n")
+    # The shown output doesn't fit into the spool, but stays readable while it is shown:
+    with run_peepo_in_pty(command_file, "--viewport", "--rows=5", "--spool-size=100K") as (proc, master):
+        assert b"OK (ran 2/2)" in read_pty(master, until=b"cmd 2/2")
+        # Lets tidy_spool run:
+        read_pty(master, seconds=1)
+        os.write(master, b"\x1b[6~")
+        assert b"4\x1b[0m\r\n5\x1b[0m\r\n6\x1b[0m\r\n" in read_pty(master, until=b"cmd 2/2")
+
+        # Moving to another command shows only its status line:
+        os.write(master, b"\x1b[A")
+        output = read_pty(master, until=b"cmd 1/2")
+        assert output.count(b"OK (") == 1
+    assert proc.returncode == 0
+
+
+def test_plain_output_captured_with_colored_output():
+    delete_spool()
+    returncode, stdout, stderr = run_peepo(f"{TEST_DIR}/testdata/test_color.input.sh")
+    assert stdout.startswith("red\n")
+
+    # The first command's plain output was captured in the same run, so it isn't rerun and has no escape codes:
+    returncode, stdout, stderr = run_peepo(f"{TEST_DIR}/testdata/test_color_then_cat.input.sh")
+    assert returncode == 0
+    assert stderr == ""
+    assert stdout == "red\n\n\nOK (ran 1/2) cmd 2/2: cat -v"
+
+
+def test_run_warm():
+    for case in CASES:
+        delete_spool()
+        print(f"Testcase {case['input']}")
+
+        returncode, stdout, stderr = run_peepo(case["input"], extra_args="--warm")
+        assert returncode == 0
+        assert stderr == ""
+        assert stdout == load_file(case["output"]) + case["status"]
+
+    delete_spool()
+    returncode, stdout, stderr = run_peepo(f"{TEST_DIR}/testdata/test_python_venv.input.sh", extra_args="--warm")
+    assert stdout == "OK (ran 1/1) cmd 1/1: from docopt import docopt"
+
+
+def test_run_warm_error():
+    delete_spool()
+    returncode, stdout, stderr = run_peepo(f"{TEST_DIR}/testdata/test_error.input.sh", extra_args="--warm")
+    assert returncode == 0
+    assert stderr + stdout == load_file(
+        f"{TEST_DIR}/testdata/test_error.output.txt") + "\nFAILED (ran 1/3) cmd 1/3: cat nonexistentfile"
+
+
+def test_file_dependencies():
+    delete_spool()
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    data_file = f"{SPOOL_DIR}/data.txt"
+    write_file(data_file, "a\nb\n")
+    # The file is found in the command itself or has to be declared with a directive:
+    command_files = [f"{SPOOL_DIR}/deps_found.input.sh", f"{SPOOL_DIR}/deps_declared.input.sh"]
+    write_file(command_files[0], f"cat {data_file}\nxargs echo\n")
+    write_file(command_files[1], f"#@deps {data_file}\ncat {SPOOL_DIR}/data.*\nxargs echo\n")
+
+    for command_file in command_files:
+        returncode, stdout, stderr = run_peepo(command_file)
+        assert stdout == "a b\n\n\nOK (ran 2/2) cmd 2/2: xargs echo"
+
+    write_file(data_file, "a\nb\nc\n")
+    for command_file in command_files:
+        returncode, stdout, stderr = run_peepo(command_file)
+        assert returncode == 0
+        assert stderr == ""
+        assert stdout == "a b c\n\n\nOK (ran 2/2) cmd 2/2: xargs echo"
+
+        returncode, stdout, stderr = run_peepo(command_file)
+        assert stdout == "a b c\n\n\nOK (ran 0/2) cmd 2/2: xargs echo"
+
+
+def test_output_files_not_dependencies():
+    command_file = f"{SPOOL_DIR}/outputs.input.sh"
+    output_file = f"{SPOOL_DIR}/out.txt"
+    for command in [f"seq 1 3 | tee {output_file}", f"seq 1 3 > {output_file}; echo 3", f"seq 3 | sort -o {output_file}; echo 3"]:
+        print(f"Testcase {command!r}")
+        delete_spool()
+        os.makedirs(SPOOL_DIR, exist_ok=True)
+        write_file(command_file, f"{command}\nwc -l\n")
+        # The file the first command writes isn't its input, so it doesn't rerun:
+        for cmds_ran in [2, 0, 0]:
+            returncode, stdout, stderr = run_peepo(command_file)
+            assert returncode == 0
+            assert stdout.endswith(f"OK (ran {cmds_ran}/2) cmd 2/2: wc -l")
+
+
+def test_early_cutoff():
+    delete_spool()
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    command_file = f"{SPOOL_DIR}/cutoff.input.sh"
+    # Each run of the third command leaves a file named after the shell's pid behind:
+    write_file(command_file, f"seq 3 -1 1\nsort -n\n(sh\n    touch {SPOOL_DIR}/run-$$; cat\nsh)\nwc -l\n")
+    run_peepo(command_file, extra_args="--cutoff")
+
+    # The changed command has the same output as before, so the commands after it use their cached outputs:
+    write_file(command_file, f"seq 3 -1 1\nsort -n -s\n(sh\n    touch {SPOOL_DIR}/run-$$; cat\nsh)\nwc -l\n")
+    returncode, stdout, stderr = run_peepo(command_file, extra_args="--cutoff")
+    assert returncode == 0
+    assert stderr == ""
+    assert stdout == "3\n\n\nOK (ran 1/4) cmd 4/4: wc -l"
+    assert len([f for f in os.listdir(SPOOL_DIR) if f.startswith("run-")]) == 1
+
+    # A different output reruns them:
+    write_file(command_file, f"seq 3 -1 1\nsort -n -r\n(sh\n    touch {SPOOL_DIR}/run-$$; cat\nsh)\nwc -l\n")
+    returncode, stdout, stderr = run_peepo(command_file, extra_args="--cutoff")
+    assert stdout == "3\n\n\nOK (ran 3/4) cmd 4/4: wc -l"
+    assert len([f for f in os.listdir(SPOOL_DIR) if f.startswith("run-")]) == 2
+
+    # Without --cutoff, the commands after a changed command rerun:
+    write_file(command_file, f"seq 3 -1 1\nsort -n -k1\n(sh\n    touch {SPOOL_DIR}/run-$$; cat\nsh)\nwc -l\n")
+    returncode, stdout, stderr = run_peepo(command_file)
+    assert stdout == "3\n\n\nOK (ran 3/4) cmd 4/4: wc -l"
+
+
+def test_block_scripts_named_by_content():
+    delete_spool()
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    command_file = f"{SPOOL_DIR}/blocks.input"
+    write_file(command_file, "echo a\n(sh\n    cat\nsh)\n")
+    run_peepo(command_file)
+    write_file(command_file, "echo a\n(sh\n    tr a b\nsh)\n")
+    returncode, stdout, stderr = run_peepo(command_file)
+
+    # The changed block got a new script instead of overwriting the one of the previous block:
+    assert stdout == "b\n\n\nOK (ran 1/2) cmd 2/2: tr a b"
+    assert count_spool_files(".sh") == 2
+
+
+def test_cache_directives():
+    command_file = f"{SPOOL_DIR}/directives.input.sh"
+    # Command file content, extra args of the second run and commands it reran:
+    cases = [("echo a\n#@always\ncat\n", "", 1), ("echo a\n#@ttl 0s\ncat\n", "", 1), ("echo a\n#@ttl 1h\ncat\n", "", 0),
+             ("#@pin\necho a\ncat\n", "--force", 1)]
+    for content, extra_args, cmds_ran in cases:
+        print(f"Testcase {content!r}")
+        delete_spool()
+        os.makedirs(SPOOL_DIR, exist_ok=True)
+        write_file(command_file, content)
+        returncode, stdout, stderr = run_peepo(command_file)
+        assert stdout == "a\n\n\nOK (ran 2/2) cmd 2/2: cat"
+
+        returncode, stdout, stderr = run_peepo(command_file, extra_args=extra_args)
+        assert returncode == 0
+        assert stderr == ""
+        assert stdout == f"a\n\n\nOK (ran {cmds_ran}/2) cmd 2/2: cat"
+
+
+def test_invalid_directives():
+    command_file = f"{SPOOL_DIR}/invalid_directives.input.sh"
+    # Command file content, extra args, the error and the status line:
+    cases = [("#@ don't run this yet\necho a\ncat\n", "", None, "OK (ran 2/2) cmd 2/2: cat"),
+             ("echo a\n#@ttl 5x\ncat\n", "", "#@ttl 5x: Invalid duration: 5x",
+              "FAILED (ran 0/2) cmd 2/2 (#@ttl 5x: Invalid duration:..."),
+             ("#@deps 'a.csv\necho a\n", "", "#@deps 'a.csv: No closing quotation",
+              "FAILED (ran 0/1) cmd 1/1 (#@deps 'a.csv: No closing q..."),
+             ("echo a\n#@branch b from c\ncat\n", "--branch=b", "Unknown branch: c",
+              "FAILED (ran 0/2) cmd 2/2 (b, Unknown branch: c): cat")]
+    for content, extra_args, error, status in cases:
+        print(f"Testcase {content!r}")
+        delete_spool()
+        os.makedirs(SPOOL_DIR, exist_ok=True)
+        write_file(command_file, content)
+        returncode, stdout, stderr = run_peepo(command_file, extra_args=extra_args)
+        assert returncode == 0
+        assert stderr == ""
+        assert stdout.endswith(status)
+        if error is not None:
+            assert f"has an invalid directive: {error}\n" in stdout
+
+
+def test_branches():
+    delete_spool()
+    returncode, stdout, stderr = run_peepo(f"{TEST_DIR}/testdata/test_branches.input.sh")
+    assert returncode == 0
+    assert stderr == ""
+    assert stdout == "1\n2\n3\n\n\nOK (ran 1/1) cmd 1/1 (main): seq 1 3"
+
+    # The other branches ran in the background:
+    returncode, stdout, stderr = run_peepo(f"{TEST_DIR}/testdata/test_branches.input.sh", extra_args="--branch=count")
+    assert stdout == "3\n\n\nOK (ran 0/2) cmd 2/2 (count): wc -l"
+
+    returncode, stdout, stderr = run_peepo(f"{TEST_DIR}/testdata/test_branches.input.sh", extra_args="--branch=double")
+    assert stdout == "12\n\n\nOK (ran 0/3) cmd 3/3 (double): awk '{ print $1 * 2 }'"
+
+
+def test_preview():
+    delete_spool()
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    command_file = f"{SPOOL_DIR}/preview.input.sh"
+    write_file(command_file, "seq 1 1000\ncat\n")
+    run_peepo(command_file)
+
+    # The changed command first runs on a sample of the cached input, then on the full input:
+    write_file(command_file, "seq 1 1000\nwc -l\n")
+    returncode, stdout, stderr = run_peepo(command_file, extra_args="--preview --preview-lines=10")
+    assert returncode == 0
+    assert stderr == ""
+    assert stdout == ("10\n\n\nOK (ran 1/2) cmd 2/2 (preview): wc -l\n" "1000\n\n\nOK (ran 1/2) cmd 2/2: wc -l")
+
+    # Sampled and full outputs are cached separately:
+    returncode, stdout, stderr = run_peepo(command_file)
+    assert stdout == "1000\n\n\nOK (ran 0/2) cmd 2/2: wc -l"
+
+
+def test_stats_and_trace():
+    delete_spool()
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    command_file = f"{SPOOL_DIR}/stats.input.sh"
+    trace_file = f"{SPOOL_DIR}/trace.jsonl"
+    write_file(command_file, "seq 1 3\ncat\n")
+    returncode, stdout, stderr = run_peepo(command_file, extra_args=f"--stats --trace={trace_file}")
+    assert returncode == 0
+    assert stderr == ""
+    lines = stdout.splitlines()
+    assert lines[-3].split() == ["cmd", "cache", "wall", "cpu", "rss", "in", "out"]
+    assert [line.split()[:2] for line in lines[-2:]] == [["1", "miss"], ["2", "miss"]]
+    assert [line.split()[-2:] for line in lines[-2:]] == [["0", "6"], ["6", "6"]]
+
+    returncode, stdout, stderr = run_peepo(command_file, extra_args=f"--trace={trace_file}")
+    stages = [json.loads(line) for line in load_file(trace_file).splitlines()]
+    assert [(stage["cmd"], stage["cached"], stage["bytes_out"]) for stage in stages] == [(1, True, 6), (2, True, 6)]
+
+    # The Chrome trace event format allows leaving out the closing bracket:
+    run_peepo(command_file, extra_args=f"--force --trace={trace_file} --trace-format=chrome")
+    events = json.loads(load_file(trace_file).rstrip().rstrip(",") + "]")
+    assert [(event["ph"], event["cat"], event["args"]["exit_status"]) for event in events] == [("X", "ran", 0)] * 2
+    assert events[0]["args"]["cpu_seconds"] >= 0
+
+
+def test_prefetch_neighbours():
+    delete_spool()
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    with run_peepo_in_pty(f"{TEST_DIR}/testdata/test1.input.sh") as (_, master):
+        # While idle, peepo caches the colored outputs of the previous and the first command:
+        deadline = time.monotonic() + 10
+        while count_spool_files(".col") < 3 and time.monotonic() < deadline:
+            read_pty(master, seconds=0.1)
+
+    assert count_spool_files(".col") == 3
+    assert count_spool_files(".out") == 4
+
+
+def test_watch_command_file():
+    delete_spool()
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    command_file = f"{SPOOL_DIR}/watch.input.sh"
+    # Each run leaves a file named after the shell's pid behind:
+    command = f"#@always\ntouch {SPOOL_DIR}/run-$$; echo a"
+    write_file(command_file, command + "\n")
+    with run_peepo_in_pty(command_file, "--debounce=300") as (_, master):
+        assert count_runs_after(master, 2) == 1
+        # A burst of writes runs the commands once:
+        for k in range(3):
+            write_file(command_file, f"{command} # {k}\n")
+        assert count_runs_after(master, 2) == 2
+        # Writing the same content doesn't run them:
+        write_file(command_file, f"{command} # 2\n")
+        assert count_runs_after(master, 2) == 2
+        # Neither does touching the file:
+        os.utime(command_file)
+        assert count_runs_after(master, 1) == 2
+        # Saving by renaming a new file to the command file does:
+        write_file(f"{command_file}.new", command + "\n")
+        os.replace(f"{command_file}.new", command_file)
+        assert count_runs_after(master, 2) == 3
+
+
+def test_prefetch_keeps_outputs_of_the_run():
+    command_file = f"{SPOOL_DIR}/always.input.sh"
+    # Each run of the first command leaves a file named after the shell's pid behind:
+    always = f"#@always\ntouch {SPOOL_DIR}/run-$$; seq 1 5\n"
+    for content in [always + "cat\ncat\n", always + "cat\n#@branch other\nwc -l\n"]:
+        print(f"Testcase {content!r}")
+        delete_spool()
+        os.makedirs(SPOOL_DIR, exist_ok=True)
+        write_file(command_file, content)
+        with run_peepo_in_pty(command_file) as (_, master):
+            # The neighbours and the other branches use the output of the #@always command from the same run:
+            assert count_runs_after(master, 2) == 1
+            # Moving to another command is a new run:
+            os.write(master, b"\x1b[A")
+            assert count_runs_after(master, 2) == 2
+
+
+def test_pin_keeps_plain_output():
+    delete_spool()
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    command_file = f"{SPOOL_DIR}/pin.input.sh"
+    # Each run of the first command leaves a file named after the shell's pid behind:
+    write_file(command_file, f"#@pin\ntouch {SPOOL_DIR}/run-$$; echo a\ncat\n")
+    with run_peepo_in_pty(command_file) as (_, master):
+        assert count_runs_after(master, 2) == 1
+        # The pinned command only has its plain output cached, which is shown instead of rerunning it:
+        os.write(master, b"\x1b[A")
+        assert b"a\r\n" in read_pty(master, until=b"cmd 1/2")
+        assert count_runs_after(master, 1) == 1
+
+
+def test_daemon():
+    delete_spool()
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    daemon = subprocess.Popen(["./peepo.py", "--daemon", f"--spool={SPOOL_DIR}", "--jobs=2"], stdin=subprocess.DEVNULL)
+    try:
+        deadline = time.monotonic() + 10
+        while not os.path.exists(f"{SPOOL_DIR}/daemon.sock") and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+        # Attached clients show the same output as peepo on its own, and share the daemon's cache:
+        returncode, stdout, stderr = run_peepo(CASES[0]["input"], extra_args="--attach")
+        assert stderr == ""
+        assert stdout == load_file(CASES[0]["output"]) + CASES[0]["status"]
+        returncode, stdout, stderr = run_peepo(CASES[0]["input"], extra_args="--attach")
+        assert stdout == load_file(CASES[0]["output"]) + "\n\nOK (ran 0/4) cmd 4/4: tr '\\n' ','"
+
+        # Keys are passed on to the daemon, which ends the session on q:
+        with run_peepo_in_pty(CASES[0]["input"], "--attach") as (client, master):
+            read_pty(master, until=b"cmd 4/4")
+        assert client.returncode == 0
+    finally:
+        daemon.terminate()
+        daemon.wait(timeout=10)
+
+    assert not os.path.exists(f"{SPOOL_DIR}/daemon.sock")
+
+
+def test_batch():
+    delete_spool()
+    input_dir = f"{SPOOL_DIR}/inputs"
+    os.makedirs(f"{input_dir}/sub")
+    for name, lines in [("a.log", 3), ("b.log", 5), ("sub/c.log", 7)]:
+        write_file(f"{input_dir}/{name}", "x\n" * lines)
+    command_file = f"{SPOOL_DIR}/batch.input"
+    write_file(command_file, "wc -l\nsed 's/^/lines: /'\n")
+    batch_args = f"{command_file} --spool={SPOOL_DIR} --batch='{input_dir}/**/*.log' --jobs=2"
+
+    returncode, stdout, stderr = run_with_bash(f"./peepo.py {batch_args}")
+    assert stdout == "lines: 3\nlines: 5\nlines: 7\n"
+    assert stderr.count("OK (ran 2/2)") == 3
+
+    # Only the changed input runs again:
+    write_file(f"{input_dir}/b.log", "x\n")
+    returncode, stdout, stderr = run_with_bash(f"./peepo.py {batch_args} --batch-out={SPOOL_DIR}/out")
+    assert stdout == ""
+    assert stderr.count("OK (ran 0/2)") == 2
+    assert stderr.count("OK (ran 2/2)") == 1
+    assert load_file(f"{SPOOL_DIR}/out/b.log") == "lines: 1\n"
+    assert load_file(f"{SPOOL_DIR}/out/sub/c.log") == "lines: 7\n"
+
+    # The outputs hold only the stdout of the last command, which doesn't run in a terminal:
+    write_file(command_file, "wc -l\n(py\n    print('warning: something', file=sys.stderr)\n"
+               "    print(sys.stdout.isatty())\npy)\n")
+    returncode, stdout, stderr = run_with_bash(f"./peepo.py {batch_args} --batch-out={SPOOL_DIR}/out")
+    assert stderr.count("warning: something") == 3
+    assert load_file(f"{SPOOL_DIR}/out/a.log") == "False\n"
+
+
 def test_convert_script():
     convert_file = f"{SPOOL_DIR}/convert_output.sh"
     delete_spool()
@@ -181,10 +780,56 @@ def strip_shell_control_chars(str_bytes):
     return re.sub(r"\x1b\[([0-9;]*m|2J)", '', str_bytes.decode("utf8"))
 
 
+@contextlib.contextmanager
+def run_peepo_in_pty(command_file, *extra_args):
+    """Runs peepo in a pseudo terminal to send it keys, and quits it with q at the end of the with block."""
+    master, slave = pty.openpty()
+    proc = subprocess.Popen(["./peepo.py", command_file, f"--spool={SPOOL_DIR}", "--cols=60", *extra_args],
+                            stdin=slave,
+                            stdout=slave,
+                            stderr=slave)
+    os.close(slave)
+    try:
+        yield proc, master
+    finally:
+        os.write(master, b"q")
+        proc.wait(timeout=10)
+        os.close(master)
+
+
+def read_pty(master, until=None, seconds=10):
+    """Reads the output of peepo in a pseudo terminal until it contains until, or for the given seconds."""
+    output = b""
+    deadline = time.monotonic() + seconds
+    while (until is None or until not in output) and time.monotonic() < deadline:
+        if select.select([master], [], [], 0.1)[0]:
+            try:
+                output += os.read(master, 4096)
+            except OSError:
+                # peepo exited:
+                break
+    return output
+
+
+def count_runs_after(master, seconds):
+    """Returns how often commands that leave a run-<pid> file behind ran, after reading peepo's output for a while."""
+    read_pty(master, seconds=seconds)
+    return len([f for f in os.listdir(SPOOL_DIR) if f.startswith("run-")])
+
+
+def count_spool_files(suffix):
+    return len([f for f in os.listdir(SPOOL_DIR) if f.endswith(suffix)])
+
+
 def load_file(file_path):
     with open(file_path, 'r') as file:
         return file.read()
 
 
+def write_file(file_path, content):
+    with open(file_path, 'w') as file:
+        file.write(content)
+
+
 def delete_spool():
     shutil.rmtree(f"{SPOOL_DIR}", ignore_errors=True)
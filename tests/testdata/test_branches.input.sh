@@ -0,0 +1,7 @@
+seq 1 3
+#@branch sum
+awk '{ s += $1 } END { print s }'
+#@branch count
+wc -l
+#@branch double from sum
+awk '{ print $1 * 2 }'
@@ -0,0 +1,2 @@
+printf '\033[31mred\033[0m\n'
+cat -v
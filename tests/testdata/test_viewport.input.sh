@@ -0,0 +1 @@
+seq 1 1000